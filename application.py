@@ -7,32 +7,126 @@ import logging
 import base64
 import urllib2
 import json
+from functools import partial
 from flask import Flask
 from flask import render_template
 from flask import request
-from jinja2 import Environment
-from jinja2 import FileSystemLoader
+from flask import jsonify
+from flask import Response
+from flask import make_response
+from boto.exception import S3ResponseError
 from datetime import datetime
 from datetime import timedelta
 from libs.utils import gen_policy
 from libs.utils import upload_s3
 from libs.utils import sign_policy
 from libs.utils import valid_name
-from libs.utils import get_s3_files
-from libs.utils import get_s3_files_table
-from libs.utils import get_temp_s3_url
+from libs.utils import get_s3_files_page
+from libs.utils import get_download_url
 from libs.utils import setup_logging
-from libs.utils import ztree_files
+from libs.utils import cached_versions
+from libs.utils import index_etag
+from libs.utils import listing_etag
+from libs.utils import iter_ztree_nodes
+from libs.utils import iter_json_array
 from libs.utils import get_user
 from libs.utils import get_env_creds
 from libs.utils import create_folder_and_lifecycle
 from libs.utils import init
 from libs.utils import dt_to_string
+from libs.portals import create_portals
+from libs.stats import folder_usage
+from libs.records import format_size
+from libs.download import folder_versions
+from libs.download import selected_versions
+from libs.download import zip_download
+from libs.download import iter_manifest
+from libs.download import MANIFEST_FORMATS
+from libs.portals import render_portal_page
+from libs.portals import read_portal_specs
+from libs.portals import MAX_POST_SIZE
+from libs.multipart import PortalUpload
+from libs.utils import s3_pool_stats
+from libs.utils import listing_cache_stats
+from libs.utils import url_cache_stats
+from libs.utils import flight_stats
+from libs.metrics import registry
+from libs.metrics import begin_request
+from libs.metrics import end_request
+from libs.metrics import current_request
+from libs.metrics import CountedBody
+from libs.metrics import http_requests
+from libs.metrics import http_latency
+from libs.metrics import http_bytes
+from libs.metrics import http_s3_calls
+from libs.metrics import http_listing_pages
+from libs.metrics import TimedTemplate
+from libs.compress import gzip_response
 
 
 application = app = Flask(__name__)
-init()
+app.jinja_env.template_class = TimedTemplate
+logging = setup_logging()
+# SKIP_INIT=1 leaves preparing the bucket to the caller (eg benchmarks)
+if os.environ.get('SKIP_INIT') != '1':
+    init()
 PREFIX = 'uploads/'  # name of uploads folder in bucket. must end in /
+PAGE_SIZE = 500  # rows per page of the file table; one LIST request each
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))  # 0 disables compression
+
+
+@app.before_request
+def start_timer():
+    begin_request()
+
+
+@app.after_request
+def record_request(response):
+    ''' records the request's latency, s3 calls and response size, and
+        writes a structured access log line. for streamed responses that
+        happens once the body has been sent, so the s3 calls made while
+        producing it are counted '''
+    endpoint = request.endpoint or 'unknown'
+    finish = partial(finish_request, current_request(), endpoint,
+                     request.method, request.path, response.status_code,
+                     get_user(request))
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = CountedBody(response.response, endpoint, finish)
+    else:
+        http_bytes.inc(response.content_length or 0, endpoint)
+        finish(response.content_length or 0)
+    return response
+
+
+def finish_request(counts, endpoint, method, path, status, user, sent):
+    seconds, s3_calls, listing_pages = end_request(counts)
+    http_requests.inc(1, endpoint, method, str(status))
+    http_latency.observe(seconds, endpoint)
+    http_s3_calls.observe(s3_calls, endpoint)
+    http_listing_pages.observe(listing_pages, endpoint)
+    logging.info('%s %s %s' % (method, path, status),
+                 extra={'endpoint': endpoint,
+                        'status': status,
+                        'duration_ms': round(seconds * 1000, 1),
+                        's3_calls': s3_calls,
+                        'listing_pages': listing_pages,
+                        'bytes': sent,
+                        'user': user})
+
+
+@app.after_request
+def compress(response):
+    # runs before record_request, which then counts the compressed bytes
+    return gzip_response(response, request.accept_encodings, GZIP_LEVEL)
+
+
+@app.after_request
+def allow_portal_origin(response):
+    # generated portals are served from the bucket and call the multipart
+    # endpoints cross-origin; they authenticate with their signed policy
+    if request.path.startswith('/mpu/'):
+        response.headers['Access-Control-Allow-Origin'] = '*'
+    return response
 
 
 @app.errorhandler(404)
@@ -40,6 +134,28 @@ def page_not_found(e):
     return render_template('error.html', message='Not Found')
 
 
+def not_modified(etag, last_modified=None):
+    ''' a 304 response if the client already holds the listing tagged
+        etag (If-None-Match), otherwise None '''
+    if etag is None or not request.if_none_match.contains_weak(etag):
+        return None
+    return validated(Response(status=304), etag, last_modified)
+
+
+def validated(response, etag, last_modified=None):
+    ''' adds a listing's validators to response. clients must revalidate
+        every time; If-Modified-Since alone isn't enough to get a 304, as
+        deleting a version leaves the newest time unchanged. responses
+        without an etag are left as they are '''
+    if etag is None:
+        return response
+    response.headers['ETag'] = 'W/"%s"' % etag  # werkzeug writes w/
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.cache_control.no_cache = True
+    return response
+
+
 @app.route('/ztreeapi')
 def ztreeapi():
     if not request.is_xhr:
@@ -50,8 +166,68 @@ def ztreeapi():
     except:
         folder = ''
 
-    ztree = ztree_files(prefix=PREFIX + folder)
-    return json.dumps(ztree)
+    # ztree sends the id of the node being expanded; without one, return
+    # the top level folders (those starting with folder, when filtered)
+    path = request.args.get('id')
+    if path is None:
+        path = folder
+
+    # an index generation or a cached listing tags the response without
+    # listing s3. otherwise it is streamed as the listing arrives, untagged
+    records, last_modified = None, None
+    etag = index_etag(PREFIX + path, request.full_path)
+    if etag is None:
+        records = cached_versions(PREFIX + path, delimiter='/')
+        if records is not None:
+            etag, last_modified = listing_etag(records, request.full_path)
+    response = not_modified(etag, last_modified)
+    if response is not None:
+        return response
+    nodes = iter_ztree_nodes(prefix=PREFIX, path=path, records=records)
+    return validated(Response(iter_json_array(nodes),
+                              mimetype='application/json'),
+                     etag, last_modified)
+
+
+def _page_args():
+    ''' returns the (page_size, marker, sort, reverse) listing args of
+        the current request '''
+    try:
+        page_size = int(request.args['page_size'])
+    except:
+        page_size = PAGE_SIZE
+    marker = request.args.get('marker') or None
+    sort = request.args.get('sort', 'key')
+    reverse = request.args.get('order') == 'desc'
+    return page_size, marker, sort, reverse
+
+
+@app.route('/filesapi')
+def files_api():
+    folder = request.args.get('folder', '')
+    page_size, marker, sort, reverse = _page_args()
+    try:
+        rows, next_marker = get_s3_files_page(prefix=PREFIX + folder,
+                                              page_size=page_size,
+                                              marker=marker,
+                                              sort=sort,
+                                              reverse=reverse)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+
+    files = []
+    for f in rows:
+        files.append({'name': f['name'],
+                      'dir': f['dir'],
+                      'date': dt_to_string(f['date']),
+                      'size': f['size'],
+                      'select': '%s:%s' % (f['cb64'], f['vb64']),
+                      'url': '/gendl?keyname=%s&version=%s' % (f['cb64'],
+                                                               f['vb64'])})
+    # pages follow key order; sort and order only reorder the rows of
+    # this page, which 'sorted' tells clients walking several pages
+    sorted_by = 'listing' if sort == 'key' and not reverse else 'page'
+    return jsonify(files=files, next=next_marker, sorted=sorted_by)
 
 
 @app.route('/files')
@@ -70,16 +246,39 @@ def list_files():
         return render_template('file_list.html',
                                folder=folder)
     else:
+        page_size, marker, sort, reverse = _page_args()
+        etag = index_etag(PREFIX + folder, request.full_path)
+        response = not_modified(etag)
+        if response is not None:
+            return response
         try:
-            # get the file listing
-            s3_files = get_s3_files_table(prefix=PREFIX + folder)
+            # get the first page of the file listing; the rest is
+            # fetched by the page from /filesapi
+            s3_files, next_marker = get_s3_files_page(prefix=PREFIX + folder,
+                                                      page_size=page_size,
+                                                      marker=marker,
+                                                      sort=sort,
+                                                      reverse=reverse)
         except:
             return render_template('error.html',
                                    message='Error %s' % str(sys.exc_info()))
-        return render_template('file_list_table.html',
-                               files=s3_files,
-                               folder=folder,
-                               d2s=dt_to_string)
+        last_modified = None
+        if etag is None:
+            etag, last_modified = listing_etag([f.version for f in s3_files],
+                                               request.full_path)
+            response = not_modified(etag, last_modified)
+            if response is not None:
+                return response
+        return validated(make_response(render_template(
+                             'file_list_table.html',
+                             files=s3_files,
+                             folder=folder,
+                             next_marker=next_marker,
+                             page_size=page_size,
+                             sort=sort,
+                             order='desc' if reverse else 'asc',
+                             d2s=dt_to_string)),
+                         etag, last_modified)
 
 
 @app.route('/')
@@ -100,23 +299,84 @@ def info():
     return render_template('info.html')
 
 
+@app.route('/stats')
+def usage_stats():
+    try:
+        usage, as_of = folder_usage(PREFIX, os.environ['BUCKET'])
+    except:
+        return render_template('error.html',
+                               message='Error %s' % str(sys.exc_info()))
+    totals = {'objects': sum(u['objects'] for u in usage),
+              'versions': sum(u['versions'] for u in usage),
+              'size': format_size(sum(u['bytes'] for u in usage))}
+    return render_template('stats.html',
+                           usage=usage,
+                           totals=totals,
+                           as_of=as_of,
+                           d2s=dt_to_string)
+
+
+@app.route('/statsapi')
+def usage_stats_api():
+    try:
+        usage, as_of = folder_usage(PREFIX, os.environ['BUCKET'])
+    except:
+        logging.error('Usage stats failed: %s' % str(sys.exc_info()))
+        return jsonify(error='Error %s' % str(sys.exc_info()[1])), 500
+    for u in usage:
+        for field in ('newest', 'expires_by'):
+            if u[field] is not None:
+                u[field] = dt_to_string(u[field])
+    return jsonify(folders=usage,
+                   as_of=dt_to_string(as_of) if as_of is not None else None)
+
+
+def cache_gauges():
+    ''' the pool and cache counters of /cachestats, as metrics gauges '''
+    gauges = {}
+    for name, stats in (('s3_pool', s3_pool_stats()),
+                        ('listing_cache', listing_cache_stats()),
+                        ('url_cache', url_cache_stats()),
+                        ('s3_flights', flight_stats())):
+        for field, value in stats.items():
+            if isinstance(value, (int, long, float)):
+                gauges['%s_%s' % (name, field)] = (
+                    '%s %s' % (name.replace('_', ' '), field), value)
+    return gauges
+
+registry.collectors.append(cache_gauges)
+
+
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(),
+                    mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/cachestats')
+def cache_stats():
+    return jsonify(s3_pool=s3_pool_stats(),
+                   listing_cache=listing_cache_stats(),
+                   url_cache=url_cache_stats(),
+                   s3_flights=flight_stats())
+
+
 @app.route('/gendl')
 def generate_dl_link():
-    filelist = []
-    for i in get_s3_files('uploads'):
-        filelist.append(i[0])
     try:
         keyname = request.args['keyname']
         keyname = base64.decodestring(urllib2.unquote(keyname))
         version_id = request.args['version']
         version_id = base64.decodestring(urllib2.unquote(version_id))
-        assert keyname in filelist
-        dl_url = get_temp_s3_url(keyname, version_id)
+        download = get_download_url(keyname, version_id, PREFIX)
+        assert download is not None
+        dl_url, expires = download
         filename = keyname.split('/')[-1]
         logging.info('User [%s] generated a url for %s' % (get_user(request),
                                                            filename))
         return render_template('s3_redir_dl.html',
                                url=dl_url,
+                               expires=dt_to_string(expires),
                                keyname=keyname,
                                filename=filename)
 
@@ -126,6 +386,53 @@ def generate_dl_link():
                                        % str(sys.exc_info()))
 
 
+@app.route('/download', methods=['GET', 'POST'])
+def download():
+    ''' a folder (?folder=) or a selection of file versions (POSTed file
+        fields, cb64:vb64 as in the /gendl links) as a streamed zip, or
+        as a manifest of presigned urls with format=urls|aria2|curl '''
+    fmt = request.values.get('format', 'zip')
+    if fmt != 'zip' and fmt not in MANIFEST_FORMATS:
+        return render_template('error.html',
+                               message='Invalid format: %s' % fmt)
+    folder = request.values.get('folder', '').strip('/')
+    selection = request.form.getlist('file')
+    try:
+        if selection:
+            pairs = []
+            for token in selection:
+                cb64, vb64 = token.split(':')
+                pairs.append((base64.decodestring(urllib2.unquote(cb64)),
+                              base64.decodestring(urllib2.unquote(vb64))))
+            versions = selected_versions(pairs, PREFIX)
+            base, name = PREFIX, 'selection'
+        else:
+            assert folder != ''
+            base = PREFIX + folder + '/'
+            versions = folder_versions(base)
+            name = folder.replace('/', '_')
+    except:
+        return render_template('error.html',
+                               message='Invalid Parameters %s'
+                                       % str(sys.exc_info()))
+
+    logging.info('User [%s] downloaded %d files of %s as %s'
+                 % (get_user(request), len(versions), name, fmt))
+    if fmt == 'zip':
+        length, archive = zip_download(versions, base)
+        response = Response(archive, mimetype='application/zip')
+        response.headers['Content-Length'] = str(length)
+        filename = name + '.zip'
+    else:
+        response = Response(iter_manifest(versions, base,
+                                          os.environ['BUCKET'], fmt),
+                            mimetype='text/plain')
+        filename = name + '.txt'
+    response.headers['Content-Disposition'] = ('attachment; filename="%s"'
+                                               % filename)
+    return response
+
+
 @app.route('/generate_form', methods=['POST'])
 def generate_form():
 
@@ -153,8 +460,7 @@ def generate_form():
                                message='Invalid Expiration Date')
 
     try:
-        maxupload = request.form['maxupload']
-        max_megs = int(maxupload) / (1024 * 1024)
+        maxupload = int(request.form['maxupload'])
     except:
         return render_template('error.html',
                                message='Invalid File Size')
@@ -175,6 +481,11 @@ def generate_form():
     except:
         notes = ''
 
+    # a single POST can't upload more than 5 GiB; larger limits need the
+    # multipart mode
+    multipart = (request.form.get('multipart') == 'on' or
+                 maxupload > MAX_POST_SIZE)
+
     try:
         policy = gen_policy(bucket_name   = bucket_name,
                             expiration    = exp,
@@ -194,28 +505,26 @@ def generate_form():
                                        % str(sys.exc_info()))
 
     try:
-        env = Environment(loader=FileSystemLoader('templates'))
-        template = env.get_template('upload.html')
-        html = template.render(bucket_name=bucket_name,
-                               access_key=access_key,
-                               policy=policy,
-                               signature=signature,
-                               max_in_megs=max_megs,
-                               notes=notes,
-                               directory=directory)
+        html = render_portal_page(bucket_name, access_key, policy,
+                                  signature,
+                                  {'directory': directory,
+                                   'maxupload': maxupload,
+                                   'notes': notes,
+                                   'multipart': multipart},
+                                  api_root=portal_api_root())
     except:
         return render_template('error.html',
                                message='Error rendering template: %s'
                                        % str(sys.exc_info()))
 
     try:
-        create_folder_and_lifecycle(bucket_name=bucket_name,
-                                    directory=directory,
-                                    expiration=lc_expiration)
+        error = create_folder_and_lifecycle(bucket_name=bucket_name,
+                                            directory=directory,
+                                            expiration=lc_expiration)
     except:
-        return render_template('error.html',
-                               message='Error setting lifecycle: %s'
-                                       % str(sys.exc_info()))
+        error = 'Error setting lifecycle: %s' % str(sys.exc_info())
+    if error:
+        return render_template('error.html', message=error)
 
     try:
         url = upload_s3(contents=html,
@@ -246,9 +555,146 @@ def generate_form():
                            url_root=request.url_root,
                            portal=portal)
 
+
+@app.route('/generate_forms', methods=['POST'])
+def generate_forms():
+    ''' batch version of generate_form: takes a CSV or JSON file of portals
+        (field 'portals') and returns a JSON manifest of their urls '''
+    try:
+        bucket_name = os.environ['BUCKET']
+        access_key, secret_key = get_env_creds()
+    except:
+        return jsonify(error='Error obtaining valid creds: %s'
+                             % str(sys.exc_info())), 500
+
+    try:
+        upload = request.files['portals']
+        specs = read_portal_specs(upload.stream, upload.filename)
+    except:
+        return jsonify(error='Invalid portal list: %s'
+                             % str(sys.exc_info()[1])), 400
+
+    manifest = create_portals(specs, bucket_name, access_key, secret_key,
+                              prefix=PREFIX, api_root=portal_api_root())
+    for entry in manifest:
+        if 'url' in entry:
+            entry['files_url'] = '%sfiles?folder=%s' % (
+                request.url_root, entry['directory'])
+    logging.info('User [%s] generated %d forms'
+                 % (get_user(request), len(manifest)))
+    return jsonify(portals=manifest)
+
+
+def _portal_upload():
+    ''' the PortalUpload authorized by the policy of the current request '''
+    access_key, secret_key = get_env_creds()
+    return PortalUpload(os.environ['BUCKET'], access_key, secret_key,
+                        request.form['policy'], request.form['signature'])
+
+
+def portal_api_root():
+    ''' url the multipart portals call the /mpu/ endpoints at: the
+        PORTAL_API_ROOT env var (see portal_api.py), or this app's url '''
+    return os.environ.get('PORTAL_API_ROOT') or request.url_root
+
+
+def _multipart_s3_error(e):
+    ''' the JSON response for an S3ResponseError of a multipart call '''
+    if e.status == 404:
+        return jsonify(error='No such upload'), 404  # completed or aborted
+    logging.error('Multipart upload call failed: %s' % str(e))
+    return (jsonify(error=e.error_code or e.reason),
+            e.status if 400 <= e.status < 500 else 502)
+
+
+@app.route('/mpu/create', methods=['POST'])
+def multipart_create():
+    try:
+        upload = _portal_upload()
+        keyname, upload_id = upload.create(request.form['filename'])
+    except (KeyError, ValueError) as e:
+        return jsonify(error=str(e)), 403
+    except S3ResponseError as e:
+        return _multipart_s3_error(e)
+    logging.info('Multipart upload of %s started' % keyname)
+    return jsonify(key=keyname, upload_id=upload_id)
+
+
+@app.route('/mpu/sign', methods=['POST'])
+def multipart_sign():
+    try:
+        upload = _portal_upload()
+        url = upload.part_url(request.form['key'],
+                              request.form['upload_id'],
+                              request.form['part'],
+                              request.form['offset'],
+                              request.form['size'],
+                              request.form['total'])
+    except (KeyError, ValueError) as e:
+        return jsonify(error=str(e)), 403
+    return jsonify(url=url)
+
+
+@app.route('/mpu/parts', methods=['POST'])
+def multipart_parts():
+    try:
+        upload = _portal_upload()
+        parts = upload.parts(request.form['key'], request.form['upload_id'])
+    except (KeyError, ValueError) as e:
+        return jsonify(error=str(e)), 403
+    except S3ResponseError as e:
+        return _multipart_s3_error(e)
+    return jsonify(parts=[(number, size) for number, size, etag in parts])
+
+
+@app.route('/mpu/complete', methods=['POST'])
+def multipart_complete():
+    try:
+        upload = _portal_upload()
+        size = upload.complete(request.form['key'],
+                               request.form['upload_id'])
+    except (KeyError, ValueError) as e:
+        return jsonify(error=str(e)), 403
+    except S3ResponseError as e:
+        return _multipart_s3_error(e)
+    logging.info('Multipart upload of %s (%d bytes) completed'
+                 % (request.form['key'], size))
+    return jsonify(key=request.form['key'], size=size)
+
+
+@app.route('/mpu/abort', methods=['POST'])
+def multipart_abort():
+    try:
+        upload = _portal_upload()
+        upload.abort(request.form['key'], request.form['upload_id'])
+    except (KeyError, ValueError) as e:
+        return jsonify(error=str(e)), 403
+    except S3ResponseError as e:
+        return _multipart_s3_error(e)
+    return jsonify(key=request.form['key'])
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='HTTPS Upload')
+    parser.add_argument('--batch', metavar='FILE',
+                        help='create the portals listed in a CSV or JSON '
+                             'file, print a JSON manifest of their urls '
+                             'and exit')
+    parser.add_argument('--api-root', metavar='URL',
+                        help='url of this application, used by the '
+                             'multipart portals created by --batch')
     args = parser.parse_args()
 
-    logging = setup_logging()
-    application.run(host='0.0.0.0', debug=False)
+    if args.batch:
+        access_key, secret_key = get_env_creds()
+        with open(args.batch) as fp:
+            specs = read_portal_specs(fp, args.batch)
+        manifest = create_portals(specs, os.environ['BUCKET'],
+                                  access_key, secret_key, prefix=PREFIX,
+                                  api_root=args.api_root or
+                                  os.environ.get('PORTAL_API_ROOT'))
+        print json.dumps(manifest, indent=2)
+        sys.exit(0)
+    # a thread per request, so a slow listing doesn't hold up the others;
+    # see gunicorn.conf.py for production
+    application.run(host='0.0.0.0', debug=False, threaded=True)
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+''' end to end check of /download against the in-process s3 stand-in of
+    bench/s3stub.py: a folder zip, a selection zip and a url manifest of
+    a small folder, with several versions and a deleted file. exits
+    non-zero on the first mismatch.
+
+    run from the repository root: python bench/check_download.py '''
+
+import os
+import sys
+import logging
+import zipfile
+from StringIO import StringIO
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from s3stub import S3Stub
+
+FILES = {u'uploads/acme/a.txt': ['first a', 'second a'],
+         u'uploads/acme/sub/b.bin': ['b' * 300000],
+         u'uploads/acme/gone.txt': ['deleted later'],
+         u'uploads/acme2/c.txt': ['another folder']}
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit('FAIL: %s' % message)
+    print 'ok: %s' % message
+
+
+def main():
+    stub = S3Stub().start()
+    os.environ.update({'SKIP_INIT': '1',
+                       'S3_ENDPOINT': stub.url,
+                       'BUCKET': 'check',
+                       'AWS_ACCESS_KEY_ID': 'AKIAEXAMPLE',
+                       'AWS_SECRET_KEY': 'secret',
+                       'LISTING_CACHE_TTL': '0',
+                       'ZIP_CHUNK_MB': '1'})
+    bucket = stub.bucket('check')
+    versions = {}
+    for key, bodies in sorted(FILES.items()):
+        for body in bodies:
+            versions.setdefault(key, []).append(
+                bucket.add_version(key, body=body).version_id)
+    bucket.delete(u'uploads/acme/gone.txt')
+
+    from application import app
+    from libs.records import url_token
+    logging.getLogger().setLevel(logging.WARNING)
+    client = app.test_client()
+
+    response = client.get('/download?folder=acme')
+    check(response.status_code == 200 and
+          response.mimetype == 'application/zip', 'folder zip is served')
+    archive = zipfile.ZipFile(StringIO(response.get_data()))
+    check(archive.testzip() is None, 'folder zip crcs match')
+    check(sorted(archive.namelist()) == ['a.txt', 'sub/b.bin'],
+          'folder zip holds the current files only')
+    check(archive.read('a.txt') == 'second a', 'newest version is zipped')
+    check(int(response.headers['Content-Length']) ==
+          len(response.get_data()), 'Content-Length is exact')
+
+    selection = ['%s:%s' % (url_token(u'uploads/acme/a.txt'),
+                            url_token(versions[u'uploads/acme/a.txt'][0])),
+                 '%s:%s' % (url_token(u'uploads/acme/a.txt'),
+                            url_token(versions[u'uploads/acme/a.txt'][1])),
+                 '%s:%s' % (url_token(u'uploads/acme2/c.txt'),
+                            url_token(versions[u'uploads/acme2/c.txt'][0]))]
+    response = client.post('/download', data={'file': selection})
+    check(response.status_code == 200 and
+          response.mimetype == 'application/zip', 'selection zip is served')
+    archive = zipfile.ZipFile(StringIO(response.get_data()))
+    check(archive.testzip() is None, 'selection zip crcs match')
+    names = archive.namelist()
+    check(len(names) == 3 and archive.read(names[0]) == 'first a' and
+          archive.read(names[1]) == 'second a' and
+          archive.read('acme2/c.txt') == 'another folder',
+          'selection zip holds every selected version')
+    check(archive.getinfo(names[0]).date_time[0] >= 2000,
+          'selection zip has real modification times')
+
+    response = client.get('/download?folder=acme&format=urls')
+    urls = response.get_data().splitlines()
+    check(response.status_code == 200 and len(urls) == 2 and
+          all('versionId=' in url for url in urls),
+          'manifest lists the current files only')
+
+    response = client.post('/download', data={'file': [
+        '%s:%s' % (url_token(u'uploads/acme/a.txt'), url_token('nope'))]})
+    check('Invalid Parameters' in response.get_data(),
+          'unknown versions are refused')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+''' checks the object index's delta scans against the in-process s3
+    stand-in of bench/s3stub.py: a version delivered by an s3 event while
+    a multi-page scan of its folder is running must still be indexed
+    once that scan completes. exits non-zero on the first mismatch.
+
+    run from the repository root: python bench/check_index.py '''
+
+import os
+import sys
+import json
+import shutil
+import logging
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from s3stub import S3Stub
+from s3stub import seed
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit('FAIL: %s' % message)
+    print 'ok: %s' % message
+
+
+def event(key, version):
+    return json.dumps({'Records': [{
+        'eventName': 'ObjectCreated:Put',
+        'eventTime': '2026-01-01T00:00:00.000Z',
+        's3': {'object': {'key': key, 'versionId': version.version_id,
+                          'size': version.size}}}]}) + '\n'
+
+
+def main():
+    stub = S3Stub().start()
+    os.environ.update({'S3_ENDPOINT': stub.url,
+                       'BUCKET': 'check',
+                       'AWS_ACCESS_KEY_ID': 'AKIAEXAMPLE',
+                       'AWS_SECRET_KEY': 'secret'})
+    bucket = stub.bucket('check')
+    seed(bucket, 2500, per_folder=2500)  # one folder, three LIST pages
+
+    from libs.index import ObjectIndex
+    from libs.utils import s3_bucket
+    logging.getLogger().setLevel(logging.WARNING)
+    directory = tempfile.mkdtemp()
+    try:
+        index = ObjectIndex(os.path.join(directory, 'index.db'), s3_bucket)
+        spool = os.path.join(directory, 'events.jsonl')
+        folder = 'customer-00000'
+
+        check(index.sync_folder(folder, max_pages=1) is False,
+              'scan stops after its first page')
+        # sorts before every seeded key, so the running scan never sees it
+        key = u'uploads/%s/0-new.txt' % folder
+        version = bucket.add_version(key, body='new')
+        with open(spool, 'a') as fp:
+            fp.write(event(key, version))
+        check(index.ingest_events(spool) == 1, 'event is applied')
+        check(index.exists(key, version.version_id),
+              'event version is indexed')
+
+        while not index.sync_folder(folder, max_pages=1):
+            pass
+        check(index.exists(key, version.version_id),
+              'event version survives the scan completing')
+        versions = sum(len(v) for k, v in bucket.versions.items()
+                       if k.startswith(u'uploads/%s/' % folder))
+        check(index.folder_stats()[folder][1] == versions,
+              'scan keeps every seeded version')
+
+        while not index.sync_folder(folder):
+            pass
+        check(index.exists(key, version.version_id),
+              'a later full scan keeps it too')
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
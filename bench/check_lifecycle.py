@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+''' checks the lifecycle rule merging of libs/lifecycle.py against the
+    in-process s3 stand-in of bench/s3stub.py: rules the portal doesn't
+    manage are written back exactly as they were read, and folders are
+    only merged under one rule when no other folder lives below it.
+    exits non-zero on the first mismatch.
+
+    run from the repository root: python bench/check_lifecycle.py '''
+
+import os
+import sys
+import logging
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from s3stub import S3Stub
+
+ABORT_RULE = ('<Rule><ID>abort-mpu</ID><Filter><Prefix></Prefix></Filter>'
+              '<Status>Enabled</Status><AbortIncompleteMultipartUpload>'
+              '<DaysAfterInitiation>7</DaysAfterInitiation>'
+              '</AbortIncompleteMultipartUpload></Rule>')
+NONCURRENT_RULE = ('<Rule><ID>old-logs</ID><Filter><And><Prefix>logs/'
+                   '</Prefix><Tag><Key>keep</Key><Value>no</Value></Tag>'
+                   '</And></Filter><Status>Enabled</Status>'
+                   '<NoncurrentVersionExpiration><NoncurrentDays>30'
+                   '</NoncurrentDays></NoncurrentVersionExpiration></Rule>')
+CONFIG = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+          '<LifecycleConfiguration '
+          'xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+          '%s%s</LifecycleConfiguration>' % (ABORT_RULE, NONCURRENT_RULE))
+
+
+def check(condition, message):
+    if not condition:
+        sys.exit('FAIL: %s' % message)
+    print 'ok: %s' % message
+
+
+def main():
+    stub = S3Stub().start()
+    os.environ.update({'S3_ENDPOINT': stub.url,
+                       'BUCKET': 'check',
+                       'AWS_ACCESS_KEY_ID': 'AKIAEXAMPLE',
+                       'AWS_SECRET_KEY': 'secret'})
+    bucket = stub.bucket('check')
+
+    from libs.lifecycle import consolidate
+    from libs.lifecycle import LifecycleManager
+    from libs.utils import s3_bucket
+    logging.getLogger().setLevel(logging.WARNING)
+
+    def manager(max_rules=1000):
+        return LifecycleManager(lambda: s3_bucket('check'),
+                                max_rules=max_rules, ttl=0)
+
+    bucket.lifecycle = CONFIG
+    manager().set_expirations([('uploads/acme', 30)])
+    check(ABORT_RULE in bucket.lifecycle and
+          NONCURRENT_RULE in bucket.lifecycle,
+          'rules with filters and other actions are kept as they were')
+    check('<Filter><Prefix>uploads/acme/</Prefix></Filter>' in
+          bucket.lifecycle, 'portal rules follow the filter form in use')
+    check(manager().rules() == {'uploads/acme/': 30},
+          'only the portal rule is read back as managed')
+
+    rules = {'uploads/acme/': 30, 'uploads/acorn/': 30, 'uploads/zz/': 10}
+    check(consolidate(rules, 2, 'uploads/') ==
+          {'uploads/ac': 30, 'uploads/zz/': 10},
+          'folders sharing an expiration are merged')
+    listing = {'uploads/ac': ['uploads/acme/', 'uploads/acorn/',
+                              'uploads/acid/']}
+    try:
+        consolidate(rules, 2, 'uploads/', listing=listing.get)
+        merged = True
+    except ValueError:
+        merged = False
+    check(not merged, 'a folder without a rule blocks the merge')
+
+    # the same through the manager: uploads/acid has files but no rule
+    bucket.lifecycle = None
+    bucket.add_version(u'uploads/acid/keep.txt', body='keep')
+    for folder in ('acme', 'acorn', 'azure'):
+        bucket.add_version(u'uploads/%s/f.txt' % folder, body='x')
+    m = manager(max_rules=2)
+    m.set_expirations([('uploads/acme', 30), ('uploads/azure', 30)])
+    try:
+        m.set_expirations([('uploads/acorn', 30)])
+        written = True
+    except ValueError:
+        written = False
+    check(not written and 'uploads/ac<' not in bucket.lifecycle,
+          'no rule is written that would expire uploads/acid')
+    m.set_expirations([('uploads/acid', 30), ('uploads/acorn', 30)])
+    check(manager().rules() == {'uploads/ac': 30, 'uploads/azure/': 30},
+          'the merge is made once every folder below has the rule')
+
+if __name__ == '__main__':
+    main()
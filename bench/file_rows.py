@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+''' cost of turning a listing into file table rows: the per row dicts
+    built with strptime and eager base64 link tokens, against FileRow.
+    times building the rows of a synthetic listing of -n versions, sorting
+    them by date, and rendering the fields of one 500 row page.
+
+    run from the repository root: python bench/file_rows.py [-n 1000000] '''
+
+import os
+import sys
+import time
+import urllib2
+import argparse
+from datetime import datetime
+from datetime import timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.records import S3Version
+from libs.records import FileRow
+
+PREFIX = 'uploads/'
+PAGE = 500
+FIELDS = ('name', 'dir', 'v_id', 'date', 'size', 'cb64', 'vb64', 'key')
+
+
+def listing(n):
+    start = datetime(2015, 1, 1)
+    return [S3Version('%scustomer-%d/file-%07d.tar.gz' % (PREFIX, i % 500, i),
+                      'vErSiOn.%032d' % i,
+                      (start + timedelta(seconds=i * 7)).strftime(
+                          '%Y-%m-%dT%H:%M:%S.000Z'),
+                      (i * 7919) % (10 * 1024 ** 3))
+            for i in xrange(n)]
+
+
+def dict_row(f, prefix):
+    ''' the row builder FileRow replaced '''
+    size_in_mb = '%.2f' % (float(f.size) / (1024*1024))
+    key = f.name[len(prefix):]
+    directory = key.partition('/')[0]
+    filename = key.partition('/')[-1]
+    cb64 = urllib2.quote((f.name).encode('base64').rstrip())
+    vb64 = urllib2.quote(f.version_id.encode('base64').rstrip())
+    dfmt = '%Y-%m-%dT%H:%M:%S.000Z'
+    date = datetime.strptime(f.last_modified, dfmt)
+    return {'name': filename, 'dir': directory, 'v_id': f.version_id,
+            'date': date, 'size': size_in_mb, 'cb64': cb64, 'vb64': vb64,
+            'key': key}
+
+
+def run(records, build, sort_key):
+    started = time.time()
+    rows = [build(f, PREFIX) for f in records]
+    built = time.time()
+    rows.sort(key=sort_key, reverse=True)
+    ordered = time.time()
+    for row in rows[:PAGE]:
+        [row[field] for field in FIELDS]
+    rendered = time.time()
+    return built - started, ordered - built, rendered - ordered
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=1000000, help='versions')
+    args = parser.parse_args()
+
+    records = listing(args.n)
+    for f in records[:1000]:
+        old, new = dict_row(f, PREFIX), FileRow(f, PREFIX)
+        assert all(old[field] == new[field] for field in FIELDS)
+
+    print '%d versions          build    sort  render %d    total' % (
+        args.n, PAGE)
+    for label, build, sort_key in (
+            ('dicts', dict_row, lambda d: d['date']),
+            ('FileRow', FileRow, lambda r: r.last_modified)):
+        times = run(records, build, sort_key)
+        print '%-20s %6.2fs %6.2fs %6.3fs %7.2fs' % ((label,) + times +
+                                                   (sum(times),))
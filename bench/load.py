@@ -0,0 +1,192 @@
+#!/usr/bin/env python
+''' latency and s3 calls per request of the main views, run against the
+    in-process s3 stand-in of bench/s3stub.py seeded with synthetic
+    buckets of 1k, 100k and 1M object versions.
+
+    every endpoint is requested -n times per bucket size through flask's
+    test client; p50/p99 latency and the mean number of s3 requests are
+    printed, and saved as json under bench/results/ together with the
+    change in p50 against the previous run.
+
+    listing and download url caches are off unless --cache is given, so
+    each request pays for its own s3 calls.
+
+    run from the repository root:
+        python bench/load.py [-n 50] [--sizes 1000,100000,1000000] '''
+
+import os
+import sys
+import json
+import time
+import glob
+import random
+import logging
+import argparse
+import subprocess
+from datetime import datetime
+from datetime import timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'bench'))
+
+from s3stub import S3Stub
+from s3stub import seed
+
+RESULTS_DIR = os.path.join(ROOT, 'bench', 'results')
+XHR = {'X-Requested-With': 'XMLHttpRequest'}
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * len(values))))]
+
+
+def s3_calls():
+    ''' s3 requests made by the process so far '''
+    from libs.metrics import s3_requests
+    return sum(s3_requests._values.values())
+
+
+def endpoints(current, n):
+    ''' (name, method, path, kwargs) of the requests to time, n of each.
+        /gendl asks for a different current version every time '''
+    from libs.records import url_token
+    folder = current[len(current) // 2][0].split('/')[1]
+    picks = random.Random(0).sample(current, min(n, len(current)))
+    exp = (datetime.utcnow() + timedelta(days=30)).strftime('%Y-%m-%d')
+    for i in xrange(n):
+        yield 'files', 'GET', '/files', {}
+    for i in xrange(n):
+        yield 'files:folder', 'GET', '/files?folder=%s' % folder, {}
+    for i in xrange(n):
+        yield 'files:tree', 'GET', '/files?view=tree', {}
+    for i in xrange(n):
+        yield 'ztreeapi', 'GET', '/ztreeapi', {'headers': XHR}
+    for i in xrange(n):
+        yield ('ztreeapi:folder', 'GET', '/ztreeapi?id=%s/' % folder,
+               {'headers': XHR})
+    for i in xrange(n):
+        keyname, version_id = picks[i % len(picks)]
+        yield ('gendl', 'GET', '/gendl?keyname=%s&version=%s'
+               % (url_token(keyname), url_token(version_id)), {})
+    for i in xrange(n):
+        yield ('generate_form', 'POST', '/generate_form',
+               {'data': {'lifecycle': '30', 'exp': exp,
+                         'maxupload': str(1024 ** 3),
+                         'directory': 'bench-%d' % i, 'notes': ''}})
+
+
+def run_size(client, stub, size, n):
+    ''' seeds a bucket of size versions and times every endpoint on it '''
+    from libs.utils import init
+    bucket_name = 'bench-%d' % size
+    started = time.time()
+    current = seed(stub.bucket(bucket_name), size)
+    os.environ['BUCKET'] = bucket_name
+    init()
+    print 'seeded %d versions in %.1fs' % (size, time.time() - started)
+
+    samples = {}
+    for name, method, path, kwargs in endpoints(current, n):
+        calls = s3_calls()
+        started = time.time()
+        response = client.open(path, method=method, **kwargs)
+        response.get_data()  # streamed bodies are produced here
+        elapsed = time.time() - started
+        if response.status_code != 200 or 'Error' in response.data[:2000]:
+            raise RuntimeError('%s %s failed: %d %s'
+                               % (method, path, response.status_code,
+                                  response.data[:500]))
+        times, calls_made = samples.setdefault(name, ([], []))
+        times.append(elapsed)
+        calls_made.append(s3_calls() - calls)
+
+    results = {}
+    for name, (times, calls_made) in samples.items():
+        results[name] = {'p50_ms': round(percentile(times, 50) * 1000, 2),
+                         'p99_ms': round(percentile(times, 99) * 1000, 2),
+                         's3_calls': float(sum(calls_made)) / len(calls_made),
+                         'requests': len(times)}
+    return results
+
+
+def previous_run():
+    paths = sorted(glob.glob(os.path.join(RESULTS_DIR, '*.json')))
+    if not paths:
+        return None
+    with open(paths[-1]) as fp:
+        return json.load(fp)
+
+
+def revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short',
+                                        'HEAD'], cwd=ROOT).strip()
+    except:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark the views '
+                                                 'against a local s3 stub')
+    parser.add_argument('-n', type=int, default=50,
+                        help='requests per endpoint and bucket size')
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated bucket sizes, in versions')
+    parser.add_argument('--cache', action='store_true',
+                        help='keep the listing and download url caches on')
+    parser.add_argument('--no-save', action='store_true',
+                        help="don't write the results to bench/results")
+    args = parser.parse_args()
+
+    stub = S3Stub().start()
+    os.environ.update({'SKIP_INIT': '1',
+                       'S3_ENDPOINT': stub.url,
+                       'BUCKET': 'bench',
+                       'AWS_ACCESS_KEY_ID': 'AKIAEXAMPLE',
+                       'AWS_SECRET_KEY': 'secret'})
+    if not args.cache:
+        os.environ['LISTING_CACHE_TTL'] = '0'
+        os.environ['DOWNLOAD_URL_MIN_REMAINING'] = os.environ.get(
+            'DOWNLOAD_URL_LIFETIME', '3600')
+    os.chdir(ROOT)  # init() syncs static/ from the working directory
+
+    from application import app
+    logging.getLogger().setLevel(logging.WARNING)  # no access log lines
+    client = app.test_client()
+
+    previous = previous_run()
+    run = {'time': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+           'revision': revision(),
+           'requests': args.n,
+           'cache': args.cache,
+           'results': {}}
+    for size in [int(s) for s in args.sizes.split(',')]:
+        results = run_size(client, stub, size, args.n)
+        run['results'][str(size)] = results
+        before = (previous or {}).get('results', {}).get(str(size), {})
+        print '%-16s %10s %10s %9s %9s' % ('%d versions' % size, 'p50 ms',
+                                           'p99 ms', 's3 calls', 'p50 diff')
+        for name in sorted(results):
+            r = results[name]
+            diff = ''
+            if name in before and before[name]['p50_ms']:
+                diff = '%+.0f%%' % (100.0 * r['p50_ms'] /
+                                    before[name]['p50_ms'] - 100)
+            print '%-16s %10.2f %10.2f %9.1f %9s' % (
+                name, r['p50_ms'], r['p99_ms'], r['s3_calls'], diff)
+        print
+
+    if not args.no_save:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        path = os.path.join(RESULTS_DIR, '%s.json'
+                            % datetime.utcnow().strftime('%Y%m%d-%H%M%S'))
+        with open(path, 'w') as fp:
+            json.dump(run, fp, indent=2, sort_keys=True)
+        print 'results saved to %s' % path
+
+
+if __name__ == '__main__':
+    main()
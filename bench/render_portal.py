@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+''' per portal render time of the upload page: a fresh jinja environment
+    per portal (how generate_form used to render it) against the shared
+    environment and pre-split PortalPage.
+
+    run from the repository root: python bench/render_portal.py [-n 2000] '''
+
+import os
+import sys
+import time
+import argparse
+from jinja2 import Environment
+from jinja2 import FileSystemLoader
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from libs.portals import TEMPLATE_DIR
+from libs.portals import render_portal_page
+from libs.utils import static_assets_url
+
+BUCKET = 'bench-bucket'
+ACCESS_KEY = 'AKIAEXAMPLE'
+
+
+def portal(i):
+    return {'directory': 'uploads/customer-%d' % i,
+            'maxupload': 5 * 1024 ** 3,
+            'notes': 'Ticket %d' % i if i % 2 else '',
+            'multipart': False}
+
+
+def fresh_env(i):
+    env = Environment(loader=FileSystemLoader(TEMPLATE_DIR))
+    p = portal(i)
+    return env.get_template('upload.html').render(
+        bucket_name=BUCKET,
+        access_key=ACCESS_KEY,
+        policy='policy%d' % i,
+        signature='signature%d' % i,
+        max_in_megs=p['maxupload'] / (1024 * 1024),
+        notes=p['notes'],
+        directory=p['directory'],
+        static_url=static_assets_url(BUCKET),
+        multipart=p['multipart'],
+        api_root=None)
+
+
+def pre_split(i):
+    return render_portal_page(BUCKET, ACCESS_KEY, 'policy%d' % i,
+                              'signature%d' % i, portal(i))
+
+
+def timeit(render, n):
+    render(0)  # warm up: template compilation, static manifest
+    start = time.time()
+    for i in range(n):
+        render(i)
+    return (time.time() - start) / n
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-n', type=int, default=2000, help='portals')
+    args = parser.parse_args()
+
+    for i in range(4):
+        assert fresh_env(i) == pre_split(i), 'pages differ for portal %d' % i
+
+    before = timeit(fresh_env, args.n)
+    after = timeit(pre_split, args.n)
+    print 'fresh environment per portal: %8.1f us/portal' % (before * 1e6)
+    print 'pre-split portal page:        %8.1f us/portal' % (after * 1e6)
+    print 'speedup:                      %8.1fx' % (before / after)
@@ -0,0 +1,402 @@
+#!/usr/bin/env python
+''' a small in-process, in-memory stand-in for the parts of the s3 rest
+    api the app uses: versioned object listings (with prefix, delimiter,
+    markers and max-keys), HEAD/GET (with Range)/PUT of object versions,
+    and the bucket's versioning, acl and lifecycle sub-resources. keys
+    can be deleted, leaving a delete marker as in a versioned bucket.
+    multipart uploads aren't supported; calls naming one get NoSuchUpload.
+    requests aren't authenticated.
+
+    start it with S3Stub().start(); point the app at it by setting
+    S3_ENDPOINT to its url. buckets can be filled directly with seed or
+    add_version, which is much faster than PUTting objects '''
+
+import re
+import time
+import bisect
+import hashlib
+import urllib
+import urlparse
+import threading
+from xml.sax.saxutils import escape
+from BaseHTTPServer import BaseHTTPRequestHandler
+from BaseHTTPServer import HTTPServer
+from SocketServer import ThreadingMixIn
+
+XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+HTTP_DATE = '%a, %d %b %Y %H:%M:%S GMT'
+ISO_DATE = '%Y-%m-%dT%H:%M:%S.000Z'
+
+
+def _upper_bound(prefix):
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class Version(object):
+    __slots__ = ('version_id', 'last_modified', 'size', 'etag', 'body',
+                 'deleted')
+
+    def __init__(self, version_id, last_modified, size, etag, body=None,
+                 deleted=False):
+        self.version_id = version_id
+        self.last_modified = last_modified  # seconds since the epoch
+        self.size = size
+        self.etag = etag
+        self.body = body  # None for seeded versions; read as zero bytes
+        self.deleted = deleted  # a delete marker
+
+
+class Bucket(object):
+    ''' keys in sorted order, each with its versions, newest first '''
+
+    def __init__(self, name):
+        self.name = name
+        self.keys = []
+        self.versions = {}
+        self.lifecycle = None
+        self.versioning = False
+        self.counter = 0
+
+    def add_version(self, key, size=0, body=None, last_modified=None):
+        ''' adds a new current version of key, returns it '''
+        if key not in self.versions:
+            bisect.insort(self.keys, key)
+            self.versions[key] = []
+        self.counter += 1
+        if body is not None:
+            size = len(body)
+            etag = hashlib.md5(body).hexdigest()
+        else:
+            etag = hashlib.md5('\0' * size).hexdigest() if size < 4096 \
+                else 'seeded%026d' % self.counter
+        version = Version('v%020d' % self.counter,
+                          last_modified or time.time(), size, etag, body)
+        self.versions[key].insert(0, version)
+        return version
+
+    def delete(self, key):
+        ''' deletes key the way a versioned bucket does, by adding a delete
+            marker as its current version '''
+        version = self.add_version(key)
+        version.deleted = True
+        return version
+
+    def get_version(self, key, version_id=None):
+        versions = self.versions.get(key)
+        if not versions:
+            return None
+        if version_id is None:
+            return None if versions[0].deleted else versions[0]
+        for version in versions:
+            if version.version_id == version_id and not version.deleted:
+                return version
+        return None
+
+    def walk(self, prefix, delimiter, marker, version_marker, max_keys,
+             all_versions):
+        ''' yields up to max_keys ('key', key, version) / ('prefix', p)
+            entries after the markers; returns via StopIteration. the
+            last yielded entry tells the caller where to resume '''
+        if marker:
+            if delimiter and marker.endswith(delimiter) and \
+                    marker.startswith(prefix):
+                start = bisect.bisect_left(self.keys, _upper_bound(marker))
+            elif version_marker and all_versions:
+                start = bisect.bisect_left(self.keys, marker)
+            else:
+                start = bisect.bisect_right(self.keys, marker)
+        else:
+            start = bisect.bisect_left(self.keys, prefix)
+        i = start
+        count = 0
+        while i < len(self.keys) and count < max_keys:
+            key = self.keys[i]
+            if not key.startswith(prefix):
+                break
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + 1]
+                yield ('prefix', common)
+                count += 1
+                i = bisect.bisect_left(self.keys, _upper_bound(common))
+                continue
+            versions = self.versions[key]
+            if not all_versions:
+                versions = [v for v in versions[:1] if not v.deleted]
+            elif version_marker and key == marker:
+                ids = [v.version_id for v in versions]
+                if version_marker in ids:
+                    versions = versions[ids.index(version_marker) + 1:]
+                version_marker = None
+            for version in versions:
+                if count >= max_keys:
+                    return
+                yield ('key', key, version)
+                count += 1
+            i += 1
+
+    def has_more(self, prefix, delimiter, entry, all_versions):
+        ''' True if anything under prefix follows the last listed entry '''
+        if entry[0] == 'prefix':
+            return any(True for _ in self.walk(prefix, delimiter, entry[1],
+                                               None, 1, all_versions))
+        return any(True for _ in self.walk(prefix, delimiter, entry[1],
+                                           entry[2].version_id, 1,
+                                           all_versions))
+
+
+def seed(bucket, versions, prefix='uploads/', per_folder=1000, per_key=3,
+         size=1024 * 1024):
+    ''' fills bucket with about versions synthetic object versions under
+        prefix: per_key versions of every key, per_folder versions per
+        customer folder, a day apart. returns the (key, version id) pairs
+        of the current versions '''
+    keys = (versions + per_key - 1) // per_key
+    per_folder_keys = max(1, per_folder // per_key)
+    start = time.time() - 86400 * per_key
+    current = []
+    for i in xrange(keys):
+        key = u'%scustomer-%05d/file-%06d.bin' % (prefix,
+                                                  i // per_folder_keys, i)
+        history = []
+        for j in xrange(per_key):
+            bucket.counter += 1
+            history.insert(0, Version('v%020d' % bucket.counter,
+                                      start + 86400 * j, size,
+                                      'seeded%026d' % bucket.counter))
+        bucket.versions[key] = history
+        current.append((key, history[0].version_id))
+    bucket.keys = sorted(bucket.versions)
+    return current
+
+
+class S3Stub(ThreadingMixIn, HTTPServer):
+    ''' the stand-in server; buckets are created on first use '''
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, host='127.0.0.1', port=0):
+        HTTPServer.__init__(self, (host, port), Handler)
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server_address
+
+    def bucket(self, name):
+        if name not in self.buckets:
+            self.buckets[name] = Bucket(name)
+        return self.buckets[name]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='s3stub')
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'  # keep-alive, like s3
+    wbufsize = -1  # one write per response; small writes stall on acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _route(self):
+        url = urlparse.urlparse(self.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        bucket = urllib.unquote(parts[0])
+        key = urllib.unquote(parts[1]).decode('utf-8') \
+            if len(parts) > 1 else ''
+        query = dict((k, v[0]) for k, v in
+                     urlparse.parse_qs(url.query,
+                                       keep_blank_values=True).items())
+        return bucket, key, query
+
+    def _body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+    def _send(self, status, body='', headers=None, head=False):
+        self.send_response(status)
+        headers = headers or {}
+        headers.setdefault('Content-Length', str(len(body)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if not head:
+            self.wfile.write(body)
+
+    def _error(self, status, code, head=False):
+        self._send(status, '<?xml version="1.0" encoding="UTF-8"?>'
+                           '<Error><Code>%s</Code><Message>%s</Message>'
+                           '</Error>' % (code, code),
+                   {'Content-Type': 'application/xml'}, head)
+
+    def _version_headers(self, version):
+        return {'ETag': '"%s"' % version.etag,
+                'Last-Modified': time.strftime(
+                    HTTP_DATE, time.gmtime(version.last_modified)),
+                'x-amz-version-id': version.version_id,
+                'Content-Type': 'application/octet-stream'}
+
+    def do_HEAD(self):
+        self._get(head=True)
+
+    def do_GET(self):
+        self._get()
+
+    def _get(self, head=False):
+        name, key, query = self._route()
+        with self.server.lock:
+            self.server.requests += 1
+            bucket = self.server.bucket(name)
+            if 'uploadId' in query:
+                return self._error(404, 'NoSuchUpload', head)
+            if key:
+                return self._get_object(bucket, key, query, head)
+            if 'lifecycle' in query:
+                if bucket.lifecycle is None:
+                    return self._error(404, 'NoSuchLifecycleConfiguration')
+                return self._send(200, bucket.lifecycle,
+                                  {'Content-Type': 'application/xml'})
+            if 'versioning' in query:
+                status = 'Enabled' if bucket.versioning else 'Suspended'
+                return self._send(200, '<VersioningConfiguration xmlns="%s">'
+                                       '<Status>%s</Status>'
+                                       '</VersioningConfiguration>'
+                                       % (XMLNS, status))
+            if 'location' in query:
+                return self._send(200, '<LocationConstraint xmlns="%s"/>'
+                                       % XMLNS)
+            return self._list(bucket, query, head)
+
+    def _get_object(self, bucket, key, query, head):
+        version = bucket.get_version(key, query.get('versionId'))
+        if version is None:
+            return self._error(404, 'NoSuchKey', head)
+        body = version.body if version.body is not None \
+            else '\0' * version.size
+        headers = self._version_headers(version)
+        status = 200
+        match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if match:
+            first = int(match.group(1))
+            last = int(match.group(2) or version.size - 1)
+            body = body[first:last + 1]
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                first, first + len(body) - 1, version.size)
+            status = 206
+        self._send(status, body, headers, head)
+
+    def _list(self, bucket, query, head):
+        all_versions = 'versions' in query
+        prefix = query.get('prefix', '').decode('utf-8')
+        delimiter = query.get('delimiter', '')
+        max_keys = min(int(query.get('max-keys', 1000)), 1000)
+        if all_versions:
+            marker = query.get('key-marker', '').decode('utf-8')
+            version_marker = query.get('version-id-marker') or None
+        else:
+            marker = query.get('marker', '').decode('utf-8')
+            version_marker = None
+        entries = list(bucket.walk(prefix, delimiter, marker, version_marker,
+                                   max_keys, all_versions))
+        truncated = bool(entries) and bucket.has_more(
+            prefix, delimiter, entries[-1], all_versions)
+
+        out = ['<?xml version="1.0" encoding="UTF-8"?>']
+        root = 'ListVersionsResult' if all_versions else 'ListBucketResult'
+        out.append('<%s xmlns="%s"><Name>%s</Name><Prefix>%s</Prefix>'
+                   '<MaxKeys>%d</MaxKeys><IsTruncated>%s</IsTruncated>'
+                   % (root, XMLNS, bucket.name, escape(prefix), max_keys,
+                      'true' if truncated else 'false'))
+        if delimiter:
+            out.append('<Delimiter>%s</Delimiter>' % escape(delimiter))
+        if truncated:
+            last = entries[-1]
+            if all_versions:
+                out.append('<NextKeyMarker>%s</NextKeyMarker>'
+                           % escape(last[1]))
+                if last[0] == 'key':
+                    out.append('<NextVersionIdMarker>%s'
+                               '</NextVersionIdMarker>'
+                               % last[2].version_id)
+            else:
+                out.append('<NextMarker>%s</NextMarker>' % escape(last[1]))
+        for entry in entries:
+            if entry[0] == 'prefix':
+                out.append('<CommonPrefixes><Prefix>%s</Prefix>'
+                           '</CommonPrefixes>' % escape(entry[1]))
+                continue
+            _, key, version = entry
+            latest = bucket.versions[key][0] is version
+            if version.deleted:
+                element = 'DeleteMarker'
+            else:
+                element = 'Version' if all_versions else 'Contents'
+            out.append('<%s><Key>%s</Key>' % (element, escape(key)))
+            if all_versions:
+                out.append('<VersionId>%s</VersionId><IsLatest>%s</IsLatest>'
+                           % (version.version_id,
+                              'true' if latest else 'false'))
+            out.append('<LastModified>%s</LastModified>' % time.strftime(
+                ISO_DATE, time.gmtime(version.last_modified)))
+            if not version.deleted:
+                out.append('<ETag>"%s"</ETag><Size>%d</Size>'
+                           '<StorageClass>STANDARD</StorageClass>'
+                           % (version.etag, version.size))
+            out.append('</%s>' % element)
+        out.append('</%s>' % root)
+        self._send(200, ''.join(out).encode('utf-8'),
+                   {'Content-Type': 'application/xml'}, head)
+
+    def do_PUT(self):
+        name, key, query = self._route()
+        body = self._body()
+        with self.server.lock:
+            self.server.requests += 1
+            bucket = self.server.bucket(name)
+            if not key:
+                if 'lifecycle' in query:
+                    bucket.lifecycle = body
+                elif 'versioning' in query:
+                    bucket.versioning = '<Status>Enabled' in body
+                return self._send(200)
+            if 'acl' in query:
+                return self._send(200)
+            if 'uploadId' in query:
+                return self._error(404, 'NoSuchUpload')
+            version = bucket.add_version(key, len(body), body)
+            self._send(200, '', self._version_headers(version))
+
+    def do_POST(self):
+        # multipart uploads aren't supported: none can be started, and
+        # every call naming one finds it missing
+        self._body()
+        with self.server.lock:
+            self.server.requests += 1
+            self._error(404 if 'uploadId' in self._route()[2] else 501,
+                        'NoSuchUpload')
+
+    def do_DELETE(self):
+        name, key, query = self._route()
+        with self.server.lock:
+            self.server.requests += 1
+            bucket = self.server.bucket(name)
+            if 'uploadId' in query:
+                return self._error(404, 'NoSuchUpload')
+            if not key and 'lifecycle' in query:
+                bucket.lifecycle = None
+            elif key and 'versionId' in query:
+                bucket.versions[key] = [
+                    v for v in bucket.versions.get(key, [])
+                    if v.version_id != query['versionId']]
+            elif key:
+                bucket.delete(key)
+            self._send(204)
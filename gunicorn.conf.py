@@ -0,0 +1,48 @@
+# gunicorn settings for serving the portal with concurrent requests:
+#
+#   pip install gunicorn futures    (gevent too, for WORKER_CLASS=gevent)
+#   gunicorn -c gunicorn.conf.py application:application
+#
+# the default gthread workers serve each request on a thread of their
+# own, so a slow S3 listing only holds up the requests waiting for it.
+# within a worker process, identical listings, HEAD requests and download
+# links in flight at the same time share a single S3 call.
+
+import os
+
+bind = '0.0.0.0:%s' % os.environ.get('PORT', '8000')
+
+# processes; each keeps its own connection pool, caches and metrics. use
+# LISTING_CACHE_PATH to share listings between them
+workers = int(os.environ.get('WEB_WORKERS', 2))
+
+# gthread: a thread per request, up to WORKER_THREADS per process.
+# gevent: a greenlet per request, up to WORKER_CONNECTIONS; boto's
+# sockets are patched, but the sqlite caches and index still block
+worker_class = os.environ.get('WORKER_CLASS', 'gthread')
+threads = int(os.environ.get('WORKER_THREADS', 16))
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 100))
+
+# zip downloads and first listings of large buckets can run for minutes
+timeout = int(os.environ.get('WORKER_TIMEOUT', 300))
+graceful_timeout = 30
+keepalive = 5
+
+# the app writes its own JSON access log lines to stdout
+accesslog = None
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    # every request can hold a pooled S3 connection, plus listing threads
+    if 'S3_POOL_SIZE' not in os.environ:
+        if worker_class == 'gevent':
+            size = worker_connections
+        else:
+            size = threads + 4
+        os.environ['S3_POOL_SIZE'] = str(size)
+    # the Storage Usage page would show lifecycle rules another worker
+    # just wrote for up to LIFECYCLE_CACHE_TTL seconds; writes read the
+    # configuration afresh either way
+    if workers > 1:
+        os.environ.setdefault('LIFECYCLE_CACHE_TTL', '0')
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+
+import os
+import time
+import sqlite3
+import threading
+import cPickle as pickle
+from collections import OrderedDict
+
+
+def _covers(a, b):
+    ''' True if a listing of prefix a and one of prefix b can overlap,
+        ie one prefix starts with the other '''
+    return a.startswith(b) or b.startswith(a)
+
+
+class ListingCache(object):
+    ''' in-process TTL + LRU cache of bucket listings.
+
+        entries are keyed by an arbitrary string and tagged with the s3
+        prefix they list, so a write below a folder can drop every listing
+        that may contain it. eviction is least recently used, bounded both
+        by entry count and by the pickled size of the cached values '''
+
+    def __init__(self, ttl=30, max_entries=256, max_bytes=64 * 1024 * 1024):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (prefix, expires, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        ''' returns the cached value for key, or None '''
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] < now:
+                if entry is not None:
+                    self._bytes -= entry[2]
+                self.misses += 1
+                return None
+            self._entries[key] = entry  # move to the most recent end
+            self.hits += 1
+            return entry[3]
+
+    def set(self, key, prefix, value):
+        ''' caches value, the listing of prefix, under key '''
+        if self.ttl <= 0:
+            return
+        size = len(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._entries[key] = (prefix, time.time() + self.ttl, size, value)
+            self._bytes += size
+            while (len(self._entries) > self.max_entries or
+                   self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted[2]
+                self.evictions += 1
+
+    def invalidate(self, prefix):
+        ''' drops every listing that may include keys under prefix '''
+        with self._lock:
+            for key, entry in self._entries.items():
+                if _covers(entry[0], prefix):
+                    del self._entries[key]
+                    self._bytes -= entry[2]
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        ''' counters and hit rate, for monitoring '''
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'backend': 'memory',
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class SqliteListingCache(ListingCache):
+    ''' ListingCache backed by a local sqlite file, so every worker
+        process on the host shares the same listings. counters are kept
+        per process '''
+
+    def __init__(self, path, ttl=30, max_entries=256,
+                 max_bytes=64 * 1024 * 1024):
+        super(SqliteListingCache, self).__init__(ttl=ttl,
+                                                 max_entries=max_entries,
+                                                 max_bytes=max_bytes)
+        self.path = path
+        self._local = threading.local()
+        with self._db() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS listings ('
+                       ' key TEXT PRIMARY KEY,'
+                       ' prefix TEXT NOT NULL,'
+                       ' expires REAL NOT NULL,'
+                       ' accessed REAL NOT NULL,'
+                       ' size INTEGER NOT NULL,'
+                       ' value BLOB NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS listings_accessed'
+                       ' ON listings (accessed)')
+
+    def _db(self):
+        ''' sqlite connections can't cross threads; keep one per thread '''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+            self._local.db = db
+        return db
+
+    def get(self, key):
+        now = time.time()
+        with self._db() as db:
+            row = db.execute('SELECT value FROM listings'
+                             ' WHERE key = ? AND expires >= ?',
+                             (key, now)).fetchone()
+            if row is not None:
+                db.execute('UPDATE listings SET accessed = ? WHERE key = ?',
+                           (now, key))
+        with self._lock:
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(str(row[0]))
+
+    def set(self, key, prefix, value):
+        if self.ttl <= 0:
+            return
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(blob) > self.max_bytes:
+            return
+        now = time.time()
+        with self._db() as db:
+            db.execute('INSERT OR REPLACE INTO listings'
+                       ' (key, prefix, expires, accessed, size, value)'
+                       ' VALUES (?, ?, ?, ?, ?, ?)',
+                       (key, prefix, now + self.ttl, now, len(blob),
+                        sqlite3.Binary(blob)))
+            db.execute('DELETE FROM listings WHERE expires < ?', (now,))
+            evicted = 0
+            while True:
+                count, size = db.execute('SELECT COUNT(*), TOTAL(size)'
+                                         ' FROM listings').fetchone()
+                if count <= self.max_entries and size <= self.max_bytes:
+                    break
+                db.execute('DELETE FROM listings WHERE key = (SELECT key'
+                           ' FROM listings ORDER BY accessed LIMIT 1)')
+                evicted += 1
+        with self._lock:
+            self.evictions += evicted
+
+    def invalidate(self, prefix):
+        with self._db() as db:
+            cur = db.execute('DELETE FROM listings'
+                             ' WHERE substr(?, 1, length(prefix)) = prefix'
+                             ' OR substr(prefix, 1, length(?)) = ?',
+                             (prefix, prefix, prefix))
+        with self._lock:
+            self.invalidations += cur.rowcount
+
+    def clear(self):
+        with self._db() as db:
+            db.execute('DELETE FROM listings')
+
+    def stats(self):
+        with self._db() as db:
+            entries, size = db.execute('SELECT COUNT(*), TOTAL(size)'
+                                       ' FROM listings').fetchone()
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {'backend': 'sqlite',
+                    'path': self.path,
+                    'entries': entries,
+                    'bytes': int(size),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+def cache_from_env(environ=os.environ):
+    ''' builds the listing cache configured by the LISTING_CACHE_* env vars.
+        LISTING_CACHE_TTL=0 disables caching '''
+    ttl = float(environ.get('LISTING_CACHE_TTL', 30))
+    max_entries = int(environ.get('LISTING_CACHE_ENTRIES', 256))
+    max_bytes = int(float(environ.get('LISTING_CACHE_MB', 64)) * 1024 * 1024)
+    path = environ.get('LISTING_CACHE_PATH')
+    if path:
+        return SqliteListingCache(path, ttl=ttl, max_entries=max_entries,
+                                  max_bytes=max_bytes)
+    return ListingCache(ttl=ttl, max_entries=max_entries, max_bytes=max_bytes)
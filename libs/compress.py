@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+
+import zlib
+
+# mimetypes of the responses worth compressing
+COMPRESSIBLE = ('text/html', 'text/plain', 'text/css', 'application/json',
+                'application/javascript')
+MIN_SIZE = 512  # smaller bodies aren't worth a gzip header
+
+
+def _compressor(level):
+    return zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+
+def gzip_data(data, level=6):
+    ''' data as a gzip stream '''
+    compressor = _compressor(level)
+    return compressor.compress(data) + compressor.flush()
+
+
+def iter_gzip(chunks, level=6):
+    ''' compresses a streamed body as it is produced. output is only
+        yielded once zlib has a block ready, so it is sent in fewer,
+        larger pieces than the input '''
+    compressor = _compressor(level)
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.flush()
+    finally:
+        close = getattr(chunks, 'close', None)
+        if close is not None:
+            close()
+
+
+def gzip_response(response, accept_encodings, level=6):
+    ''' compresses a flask response in place when the client accepts gzip
+        and the body is text. streamed bodies are compressed on the fly
+        and lose their Content-Length '''
+    response.vary.add('Accept-Encoding')
+    if (level <= 0 or 'gzip' not in accept_encodings or
+            response.status_code != 200 or response.direct_passthrough or
+            response.mimetype not in COMPRESSIBLE or
+            'Content-Encoding' in response.headers):
+        return response
+    if response.is_streamed:
+        response.response = iter_gzip(response.response, level)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < MIN_SIZE:
+            return response
+        response.set_data(gzip_data(data, level))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import os
+import boto
+from collections import deque
+from boto.utils import parse_ts
+from boto.s3.deletemarker import DeleteMarker
+from multiprocessing.pool import ThreadPool
+from libs.records import S3Version
+from libs.records import parse_timestamp
+from libs.utils import s3_bucket
+from libs.utils import get_env_creds
+from libs.utils import presign_s3_url
+from libs.utils import head_key
+from libs.utils import iter_s3_listing
+from libs.metrics import bind_request
+from libs.zipstream import ZipStream
+from libs.zipstream import ZipMember
+
+MANIFEST_FORMATS = ('urls', 'aria2', 'curl')
+
+
+def folder_versions(prefix):
+    ''' the current version of every key under prefix. keys whose newest
+        entry is a delete marker have been deleted and are left out; as
+        the listing cache and object index don't keep delete markers,
+        this lists s3 itself '''
+    versions = []
+    last = None
+    for f in iter_s3_listing(prefix):
+        if f.name == last:
+            continue  # versions of a key are listed newest first
+        last = f.name
+        if type(f) is DeleteMarker:
+            continue
+        versions.append(S3Version(f.name, f.version_id, f.last_modified,
+                                  int(f.size)))
+    return versions
+
+
+def _head(pair):
+    keyname, version_id = pair
+    key = head_key(keyname, version_id)
+    if key is None:
+        return None
+    # a HEAD has an http date; records carry listing timestamps
+    last_modified = parse_ts(key.last_modified).strftime(
+        '%Y-%m-%dT%H:%M:%S.000Z')
+    return S3Version(key.name, key.version_id or version_id, last_modified,
+                     int(key.size))
+
+
+def selected_versions(pairs, prefix, workers=8):
+    ''' the S3Versions of the (keyname, version_id) pairs under prefix,
+        looked up with parallel HEAD requests. raises KeyError if one
+        doesn't exist or lives outside prefix '''
+    for keyname, version_id in pairs:
+        if not keyname.startswith(prefix) or keyname == prefix:
+            raise KeyError(keyname)
+    if not pairs:
+        return []
+    pool = ThreadPool(min(workers, len(pairs)))
+    try:
+        versions = pool.map(bind_request(_head), pairs)
+    finally:
+        pool.close()
+    for pair, version in zip(pairs, versions):
+        if version is None:
+            raise KeyError(pair[0])
+    return versions
+
+
+def archive_names(versions, base):
+    ''' names of versions relative to base, in order. when a selection
+        holds several versions of one key, later ones get the version id
+        appended so that no two members share a name '''
+    names = []
+    seen = set()
+    for v in versions:
+        name = v.name[len(base):]
+        if name in seen:
+            name = '%s.%s' % (name, v.version_id)
+        seen.add(name)
+        names.append(name)
+    return names
+
+
+def _get_range(task):
+    keyname, version_id, first, last = task
+    with s3_bucket() as bucket:
+        key = boto.s3.key.Key(bucket, keyname)
+        return key.get_contents_as_string(
+            headers={'Range': 'bytes=%d-%d' % (first, last)},
+            version_id=version_id)
+
+
+def iter_s3_chunks(versions, chunk_size, workers):
+    ''' yields the contents of versions, in order, as chunks of at most
+        chunk_size bytes (never spanning two objects). chunks are fetched
+        with ranged GETs on workers threads, at most workers chunks ahead
+        of the consumer, so memory stays bounded by workers * chunk_size
+        however large the objects are '''
+    def ranges():
+        for v in versions:
+            for first in xrange(0, v.size, chunk_size):
+                yield (v.name, v.version_id, first,
+                       min(first + chunk_size, v.size) - 1)
+
+    pool = ThreadPool(workers)
+    pending = deque()
+    get_range = bind_request(_get_range)
+    try:
+        for task in ranges():
+            pending.append(pool.apply_async(get_range, (task,)))
+            if len(pending) >= workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+
+
+def zip_download(versions, base, workers=None, chunk_size=None):
+    ''' a streaming, store-only zip of versions, named relative to base.
+        returns (length in bytes, iterator over the archive). objects are
+        read with ZIP_WORKERS threads (default 4) in ZIP_CHUNK_MB pieces
+        (default 8) '''
+    if workers is None:
+        workers = int(os.environ.get('ZIP_WORKERS', 4))
+    if chunk_size is None:
+        chunk_size = int(os.environ.get('ZIP_CHUNK_MB', 8)) * 1024 * 1024
+    archive = ZipStream(ZipMember(name, v.size,
+                                  parse_timestamp(v.last_modified))
+                        for name, v in zip(archive_names(versions, base),
+                                           versions))
+
+    def generate():
+        chunks = iter_s3_chunks(versions, chunk_size, workers)
+        try:
+            for data in archive.stream(chunks):
+                yield data
+        finally:
+            chunks.close()  # stop the read-ahead when the client goes away
+
+    return archive.length(), generate()
+
+
+def iter_manifest(versions, base, bucket_name, fmt='urls',
+                  expires_in=None):
+    ''' yields the lines of a download manifest for versions: presigned
+        urls valid for MANIFEST_URL_LIFETIME seconds (default a day),
+        signed locally without a request per key. fmt is one of
+          urls   one url per line (wget -i)
+          aria2  aria2c input file (aria2c -i), keeping the folder layout
+          curl   curl config file (curl -K --create-dirs), same layout '''
+    if fmt not in MANIFEST_FORMATS:
+        raise ValueError('Invalid manifest format: %s' % fmt)
+    if expires_in is None:
+        expires_in = int(os.environ.get('MANIFEST_URL_LIFETIME', 86400))
+    access_key, secret_key = get_env_creds()
+    for name, v in zip(archive_names(versions, base), versions):
+        url = presign_s3_url('GET', bucket_name, v.name, access_key,
+                             secret_key, expires_in,
+                             {'versionId': v.version_id})
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        if fmt == 'aria2':
+            yield '%s\n  out=%s\n' % (url, name)
+        elif fmt == 'curl':
+            yield 'url = "%s"\noutput = "%s"\n' % (
+                url, name.replace('\\', '\\\\').replace('"', '\\"'))
+        else:
+            yield url + '\n'
@@ -0,0 +1,463 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import json
+import urllib
+import fcntl
+import sqlite3
+import logging
+import threading
+import boto
+from contextlib import contextmanager
+from boto.s3.prefix import Prefix
+from libs.records import S3Version
+from libs.records import S3Folder
+
+SCHEMA = ['CREATE TABLE IF NOT EXISTS objects ('
+          ' key TEXT NOT NULL,'
+          ' version_id TEXT NOT NULL,'
+          ' folder TEXT NOT NULL,'
+          ' size INTEGER NOT NULL,'
+          ' last_modified TEXT NOT NULL,'
+          ' scan_id INTEGER NOT NULL DEFAULT 0,'
+          ' PRIMARY KEY (key, version_id))',
+          'CREATE INDEX IF NOT EXISTS objects_order'
+          ' ON objects (key, last_modified DESC, version_id)',
+          'CREATE INDEX IF NOT EXISTS objects_folder ON objects (folder)',
+          'CREATE TABLE IF NOT EXISTS folders ('
+          ' folder TEXT PRIMARY KEY,'
+          ' synced_at REAL NOT NULL DEFAULT 0,'
+          ' key_marker TEXT,'
+          ' version_id_marker TEXT,'
+          ' scan_id INTEGER NOT NULL DEFAULT 0)',
+          'CREATE TABLE IF NOT EXISTS meta ('
+          ' name TEXT PRIMARY KEY,'
+          ' value INTEGER NOT NULL)',
+          "INSERT OR IGNORE INTO meta VALUES ('generation', 0)",
+          "INSERT OR IGNORE INTO meta VALUES ('ready', 0)",
+          "INSERT OR IGNORE INTO meta VALUES ('events_offset', 0)",
+          # per folder rollups, kept current by triggers as versions are
+          # added and removed, so usage stats never scan the objects
+          'CREATE INDEX IF NOT EXISTS objects_folder_modified'
+          ' ON objects (folder, last_modified)',
+          'CREATE TABLE IF NOT EXISTS folder_stats ('
+          ' folder TEXT PRIMARY KEY,'
+          ' objects INTEGER NOT NULL DEFAULT 0,'
+          ' versions INTEGER NOT NULL DEFAULT 0,'
+          ' bytes INTEGER NOT NULL DEFAULT 0,'
+          ' newest TEXT)',
+          'CREATE TRIGGER IF NOT EXISTS objects_added AFTER INSERT ON objects'
+          ' BEGIN'
+          '  INSERT OR IGNORE INTO folder_stats (folder) VALUES (NEW.folder);'
+          '  UPDATE folder_stats SET'
+          '   objects = objects + (SELECT COUNT(*) = 1 FROM objects'
+          '                        WHERE key = NEW.key),'
+          '   versions = versions + 1,'
+          '   bytes = bytes + NEW.size,'
+          '   newest = MAX(COALESCE(newest, \'\'), NEW.last_modified)'
+          '  WHERE folder = NEW.folder;'
+          ' END',
+          'CREATE TRIGGER IF NOT EXISTS objects_removed'
+          ' AFTER DELETE ON objects'
+          ' BEGIN'
+          '  UPDATE folder_stats SET'
+          '   objects = objects - NOT EXISTS (SELECT 1 FROM objects'
+          '                                   WHERE key = OLD.key),'
+          '   versions = versions - 1,'
+          '   bytes = bytes - OLD.size,'
+          '   newest = CASE WHEN newest > OLD.last_modified THEN newest'
+          '            ELSE (SELECT MAX(last_modified) FROM objects'
+          '                  WHERE folder = OLD.folder) END'
+          '  WHERE folder = OLD.folder;'
+          ' END',
+          "INSERT OR IGNORE INTO meta VALUES ('rollups', 0)"]
+
+# fills folder_stats for an index created before it existed
+BACKFILL = ['DELETE FROM folder_stats',
+            'INSERT INTO folder_stats'
+            ' SELECT folder, COUNT(DISTINCT key), COUNT(*), TOTAL(size),'
+            '  MAX(last_modified) FROM objects GROUP BY folder',
+            "UPDATE meta SET value = 1 WHERE name = 'rollups'"]
+
+
+def _upper_bound(prefix):
+    ''' smallest string greater than every string starting with prefix '''
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+class ObjectIndex(object):
+    ''' local sqlite index of the object versions under prefix.
+
+        each portal folder is kept in sync by its own delta scan, which
+        walks the folder's versions page by page and remembers its
+        key/version markers, so a scan can stop after a few pages and
+        pick up where it left off. versions not seen by a completed scan
+        are dropped. s3 event notifications appended to a local spool
+        file are applied in between scans.
+
+        bucket is a callable returning a context manager that yields the
+        bucket to scan (see libs.utils.s3_bucket) '''
+
+    def __init__(self, path, bucket, prefix='uploads/'):
+        self.path = path
+        self.prefix = prefix
+        self._bucket = bucket
+        self._local = threading.local()
+        self._sync_lock = threading.Lock()
+        with self._db() as db:
+            for statement in SCHEMA:
+                db.execute(statement)
+            if not self._meta('rollups'):
+                for statement in BACKFILL:
+                    db.execute(statement)
+
+    def _db(self):
+        ''' sqlite connections can't cross threads; keep one per thread '''
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            try:
+                db.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.DatabaseError:
+                pass
+            self._local.db = db
+        return db
+
+    def _meta(self, name):
+        return self._db().execute('SELECT value FROM meta WHERE name = ?',
+                                  (name,)).fetchone()[0]
+
+    def _bump(self, db):
+        db.execute("UPDATE meta SET value = value + 1"
+                   " WHERE name = 'generation'")
+
+    @property
+    def generation(self):
+        ''' incremented on every change to the indexed objects '''
+        return self._meta('generation')
+
+    def ready(self):
+        ''' True once every folder has been scanned at least once '''
+        return bool(self._meta('ready'))
+
+    def covers(self, prefix):
+        ''' True if listings of prefix can be answered from the index '''
+        return prefix.startswith(self.prefix) and self.ready()
+
+    def _folder_of(self, key):
+        return key[len(self.prefix):].partition('/')[0]
+
+    # -- keeping in sync --
+
+    def discover(self):
+        ''' registers the folders currently under prefix (one delimiter
+            LIST) and forgets folders that are gone. returns their names '''
+        with self._bucket() as bucket:
+            folders = [p.name[len(self.prefix):].rstrip('/')
+                       for p in bucket.list(prefix=self.prefix, delimiter='/')
+                       if type(p) is Prefix]
+        with self._db() as db:
+            known = set(r[0] for r in db.execute('SELECT folder FROM folders'))
+            db.executemany('INSERT OR IGNORE INTO folders (folder) VALUES (?)',
+                           [(f,) for f in folders])
+            gone = known - set(folders)
+            for folder in gone:
+                db.execute('DELETE FROM folders WHERE folder = ?', (folder,))
+                db.execute('DELETE FROM objects WHERE folder = ?', (folder,))
+                db.execute('DELETE FROM folder_stats WHERE folder = ?',
+                           (folder,))
+            if gone:
+                self._bump(db)
+        return folders
+
+    def sync_folder(self, folder, max_pages=None):
+        ''' continues the delta scan of folder for at most max_pages LIST
+            pages. returns True once the scan has completed '''
+        db = self._db()
+        row = db.execute('SELECT key_marker, version_id_marker, scan_id'
+                         ' FROM folders WHERE folder = ?',
+                         (folder,)).fetchone()
+        key_marker, version_id_marker, scan_id = row or (None, None, 0)
+        if key_marker is None:
+            scan_id += 1  # start a new pass over the folder
+
+        pages = 0
+        with self._bucket() as bucket:
+            while True:
+                rs = bucket.get_all_versions(
+                    prefix=self.prefix + folder + '/',
+                    key_marker=key_marker,
+                    version_id_marker=version_id_marker,
+                    max_keys=1000)
+                records = [(f.name, f.version_id, folder, int(f.size),
+                            f.last_modified, scan_id)
+                           for f in rs if type(f) is boto.s3.key.Key]
+                with db:
+                    cur = db.executemany('INSERT OR IGNORE INTO objects'
+                                         ' VALUES (?, ?, ?, ?, ?, ?)',
+                                         records)
+                    changed = cur.rowcount > 0
+                    db.executemany('UPDATE objects SET scan_id = ?'
+                                   ' WHERE key = ? AND version_id = ?',
+                                   [(scan_id, r[0], r[1]) for r in records])
+                    if rs.is_truncated:
+                        key_marker = rs.next_key_marker
+                        version_id_marker = rs.next_version_id_marker
+                        db.execute('INSERT OR REPLACE INTO folders'
+                                   ' (folder, synced_at, key_marker,'
+                                   '  version_id_marker, scan_id)'
+                                   ' VALUES (?, COALESCE((SELECT synced_at'
+                                   '  FROM folders WHERE folder = ?), 0),'
+                                   '  ?, ?, ?)',
+                                   (folder, folder, key_marker,
+                                    version_id_marker, scan_id))
+                    else:
+                        cur = db.execute('DELETE FROM objects'
+                                         ' WHERE folder = ? AND scan_id < ?',
+                                         (folder, scan_id))
+                        changed = changed or cur.rowcount > 0
+                        db.execute('INSERT OR REPLACE INTO folders'
+                                   ' VALUES (?, ?, NULL, NULL, ?)',
+                                   (folder, time.time(), scan_id))
+                    if changed:
+                        self._bump(db)
+                if not rs.is_truncated:
+                    return True
+                pages += 1
+                if max_pages and pages >= max_pages:
+                    return False
+
+    def sync(self, max_age=0, max_pages=None):
+        ''' one refresh pass: discovers folders, then advances the scan of
+            every folder last synced more than max_age seconds ago '''
+        with self._sync_lock:
+            self.discover()
+            stale = [r[0] for r in self._db().execute(
+                'SELECT folder FROM folders'
+                ' WHERE synced_at < ? OR key_marker IS NOT NULL',
+                (time.time() - max_age,))]
+            complete = True
+            for folder in stale:
+                complete = self.sync_folder(folder, max_pages) and complete
+            if complete and not self.ready():
+                with self._db() as db:
+                    db.execute("UPDATE meta SET value = 1"
+                               " WHERE name = 'ready'")
+
+    def mark_stale(self, prefix):
+        ''' forces the next sync to rescan folders that may contain keys
+            under prefix '''
+        folder = self._folder_of(prefix)
+        if not prefix.startswith(self.prefix):
+            folder = ''
+        with self._db() as db:
+            db.execute('UPDATE folders SET synced_at = 0'
+                       ' WHERE substr(folder, 1, length(?)) = ?',
+                       (folder, folder))
+
+    def ingest_events(self, path):
+        ''' applies s3 event notifications (one JSON message per line, as
+            delivered to an SQS queue) appended to path since the last
+            call. returns the number of records applied '''
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return 0
+        offset = self._meta('events_offset')
+        if size < offset:
+            offset = 0  # the spool file was rotated
+        applied = 0
+        with open(path) as spool:
+            spool.seek(offset)
+            with self._db() as db:
+                while True:
+                    line = spool.readline()
+                    if not line.endswith('\n'):
+                        break  # nothing more, or a partially written line
+                    offset = spool.tell()
+                    try:
+                        message = json.loads(line)
+                    except ValueError:
+                        logging.error('ingest_events: bad message %r' % line)
+                        continue
+                    for record in message.get('Records', []):
+                        applied += self._apply_event(db, record)
+                db.execute("UPDATE meta SET value = ?"
+                           " WHERE name = 'events_offset'", (offset,))
+                if applied:
+                    self._bump(db)
+        return applied
+
+    def _apply_event(self, db, record):
+        obj = record['s3']['object']
+        key = urllib.unquote_plus(obj['key'].encode('utf-8')).decode('utf-8')
+        version_id = obj.get('versionId', 'null')
+        if not key.startswith(self.prefix) or \
+                '/' not in key[len(self.prefix):]:
+            return 0  # only keys inside a portal folder are indexed
+        folder = self._folder_of(key)
+        if record['eventName'].startswith('ObjectCreated:'):
+            # event times have the same format as listing timestamps. the
+            # row joins the folder's scan in progress, if any, so that
+            # finishing it doesn't drop a version its earlier pages missed
+            db.execute('INSERT OR IGNORE INTO folders (folder) VALUES (?)',
+                       (folder,))
+            db.execute('INSERT OR IGNORE INTO objects'
+                       ' (key, version_id, folder, size, last_modified,'
+                       '  scan_id)'
+                       ' VALUES (?, ?, ?, ?, ?, (SELECT scan_id FROM folders'
+                       '                        WHERE folder = ?))',
+                       (key, version_id, folder, int(obj.get('size', 0)),
+                        record['eventTime'], folder))
+            return 1
+        if record['eventName'] == 'ObjectRemoved:Delete':
+            db.execute('DELETE FROM objects WHERE key = ? AND version_id = ?',
+                       (key, version_id))
+            return 1
+        return 0
+
+    @contextmanager
+    def scan_lock(self, wait=True):
+        ''' an exclusive lock on <path>.lock, held while scanning s3 or
+            applying events, so that the worker processes sharing the index
+            don't repeat each other's scans. yields False, without waiting,
+            when another process holds it and wait is False '''
+        with open(self.path + '.lock', 'a') as fp:
+            try:
+                fcntl.flock(fp, fcntl.LOCK_EX | (0 if wait else fcntl.LOCK_NB))
+            except IOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(fp, fcntl.LOCK_UN)
+
+    def start_refresher(self, interval, events_path=None):
+        ''' keeps the index in sync from a daemon thread: ingests the
+            event spool and refreshes folders older than interval. every
+            process may run one; a pass is skipped while another process
+            is scanning, and finds little left to do after it, since the
+            folders' sync times are shared through the index file '''
+        def refresh():
+            while True:
+                try:
+                    with self.scan_lock(wait=False) as locked:
+                        if locked and events_path:
+                            self.ingest_events(events_path)
+                        if locked:
+                            self.sync(max_age=interval, max_pages=10)
+                except:
+                    logging.error('ObjectIndex refresh failed: %s'
+                                  % str(sys.exc_info()))
+                time.sleep(interval)
+
+        thread = threading.Thread(target=refresh, name='object-index')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    # -- queries --
+
+    def _range(self, prefix):
+        if not prefix:
+            return '1', ()
+        return 'key >= ? AND key < ?', (prefix, _upper_bound(prefix))
+
+    def iter_versions(self, prefix, delimiter=''):
+        ''' yields S3Version records under prefix in s3 listing order
+            (key, then newest version first). with a delimiter, keys below
+            the next delimiter are rolled up into S3Folder records '''
+        db = self._db()
+        rest = prefix[len(self.prefix):]
+        if delimiter == '/' and '/' not in rest:
+            # top level folders come straight from the folders table
+            where, args = 'folder >= ?', (rest,)
+            if rest:
+                where, args = 'folder >= ? AND folder < ?', (
+                    rest, _upper_bound(rest))
+            for (folder,) in db.execute('SELECT folder FROM folders'
+                                        ' WHERE ' + where +
+                                        ' ORDER BY folder', args):
+                yield S3Folder(self.prefix + folder + '/')
+            return
+
+        where, args = self._range(prefix)
+        last_folder = None
+        for row in db.execute('SELECT key, version_id, last_modified, size'
+                              ' FROM objects WHERE ' + where +
+                              ' ORDER BY key, last_modified DESC, version_id',
+                              args):
+            if delimiter:
+                pos = row[0].find(delimiter, len(prefix))
+                if pos != -1:
+                    folder = row[0][:pos + len(delimiter)]
+                    if folder != last_folder:
+                        last_folder = folder
+                        yield S3Folder(folder)
+                    continue
+            yield S3Version(*row)
+
+    def page(self, prefix, page_size, key_marker=None, version_id_marker=None):
+        ''' one page of versions after the given markers, in listing order.
+            returns (records, next_markers); next_markers is None on the
+            last page, otherwise a (key_marker, version_id_marker) tuple '''
+        where, args = self._range(prefix)
+        db = self._db()
+        if key_marker:
+            marker = db.execute('SELECT last_modified FROM objects'
+                                ' WHERE key = ? AND version_id = ?',
+                                (key_marker, version_id_marker)).fetchone()
+            if marker is None:
+                where += ' AND key > ?'
+                args += (key_marker,)
+            else:
+                where += (' AND (key > ? OR (key = ? AND (last_modified < ?'
+                          ' OR (last_modified = ? AND version_id > ?))))')
+                args += (key_marker, key_marker, marker[0], marker[0],
+                         version_id_marker)
+        rows = db.execute('SELECT key, version_id, last_modified, size'
+                          ' FROM objects WHERE ' + where +
+                          ' ORDER BY key, last_modified DESC, version_id'
+                          ' LIMIT ?', args + (page_size + 1,)).fetchall()
+        records = [S3Version(*r) for r in rows[:page_size]]
+        next_markers = None
+        if len(rows) > page_size:
+            next_markers = (records[-1].name, records[-1].version_id)
+        return records, next_markers
+
+    def exists(self, key, version_id):
+        return self._db().execute('SELECT 1 FROM objects'
+                                  ' WHERE key = ? AND version_id = ?',
+                                  (key, version_id)).fetchone() is not None
+
+    def folder_stats(self):
+        ''' {folder: (object count, version count, total bytes of all
+            versions, newest last_modified)} of the non-empty folders,
+            read from the rollups without touching the objects '''
+        return dict((r[0], r[1:]) for r in self._db().execute(
+            'SELECT folder, objects, versions, bytes, newest'
+            ' FROM folder_stats WHERE versions > 0'))
+
+
+if __name__ == '__main__':
+    # run a one-off refresh, eg from cron:
+    #   python -m libs.index --events /var/spool/s3events.jsonl
+    import argparse
+    from libs.utils import get_object_index
+    parser = argparse.ArgumentParser(description='Sync the object index')
+    parser.add_argument('--events', help='s3 event notification spool file')
+    parser.add_argument('--max-age', type=float, default=0,
+                        help='only rescan folders older than this (seconds)')
+    args = parser.parse_args()
+
+    index = get_object_index(refresh=False)
+    if index is None:
+        sys.exit('OBJECT_INDEX_PATH is not set')
+    with index.scan_lock():
+        if args.events:
+            print 'Applied %d events' % index.ingest_events(args.events)
+        index.sync(max_age=args.max_age)
+    print 'Index generation %d' % index.generation
@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+
+import os
+import re
+import sys
+import time
+import threading
+import boto
+from StringIO import StringIO
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+from boto.s3.prefix import Prefix
+from boto.exception import S3ResponseError
+
+MAX_RULES = 1000  # s3 limit on the rules of a lifecycle configuration
+CONSOLIDATED = 'consolidated:'  # id prefix of rules covering many folders
+
+_RULE = re.compile(r'<Rule>.*?</Rule>', re.DOTALL)
+_NAMESPACE = re.compile(r'^{[^}]*}')
+
+
+def consolidate(rules, max_rules, base, fixed=(), listing=None):
+    ''' shrinks rules, a {prefix: days} dict, to at most max_rules entries
+        by replacing folders that share an expiration with one rule on
+        their longest common prefix. a merge is only made if every rule
+        below the common prefix has the same expiration and the result
+        doesn't overlap any other rule (s3 rejects overlapping prefixes),
+        including the fixed prefixes of rules not managed here.
+
+        listing(prefix) returns the names of the folders and keys that
+        exist below prefix; when given, a merge is also refused unless
+        each of them is covered by a rule with that expiration, so the
+        merged rule never expires a folder that had none or a longer one.
+        raises ValueError if the rules can't be made to fit '''
+    rules = dict(rules)
+    refused = set()
+    while len(rules) > max_rules:
+        ordered = sorted(rules)
+        best = None
+        for a, b in zip(ordered, ordered[1:]):
+            if rules[a] != rules[b]:
+                continue
+            common = os.path.commonprefix([a, b])
+            if len(common) <= len(base) or common in refused or \
+                    (best is not None and len(common) <= len(best)):
+                continue
+            covered = [p for p in rules if p.startswith(common)]
+            if any(rules[p] != rules[a] for p in covered):
+                continue
+            others = [p for p in rules if p not in covered] + list(fixed)
+            if any(common.startswith(p) or p.startswith(common)
+                   for p in others):
+                continue
+            best = common
+        if best is None:
+            raise ValueError('Can not fit the lifecycle rules of %d folders '
+                             'within %d rules' % (len(rules), max_rules))
+        covered = [p for p in rules if p.startswith(best)]
+        days = rules[covered[0]]
+        if listing is not None and \
+                not all(any(name.startswith(p) for p in covered)
+                        for name in listing(best)):
+            refused.add(best)  # a folder without this rule lives below it
+            continue
+        for p in covered:
+            del rules[p]
+        rules[best] = days
+    return rules
+
+
+def _tag(element):
+    return _NAMESPACE.sub('', element.tag)
+
+
+def _children(element):
+    return dict((_tag(child), child) for child in element)
+
+
+class _Config(object):
+    ''' a parsed lifecycle configuration: the portal's rules as
+        {prefix: days}, and the raw xml and prefix of every other rule,
+        which are written back exactly as they were read '''
+
+    def __init__(self, managed=None, foreign=None, filters=False):
+        self.managed = managed or {}
+        self.foreign = foreign or []  # [(xml, prefix)]
+        self.filters = filters  # rules use <Filter> rather than <Prefix>
+
+    def to_xml(self):
+        rules = [xml for xml, prefix in self.foreign]
+        for prefix, days in sorted(self.managed.items()):
+            if prefix.endswith('/'):
+                rule_id = prefix.rstrip('/')  # a single folder
+            else:
+                rule_id = CONSOLIDATED + prefix
+            if self.filters:
+                match = '<Filter><Prefix>%s</Prefix></Filter>' % escape(prefix)
+            else:
+                match = '<Prefix>%s</Prefix>' % escape(prefix)
+            rules.append('<Rule><ID>%s</ID>%s<Status>Enabled</Status>'
+                         '<Expiration><Days>%d</Days></Expiration></Rule>'
+                         % (escape(rule_id), match, days))
+        return (u'<?xml version="1.0" encoding="UTF-8"?>'
+                u'<LifecycleConfiguration>%s</LifecycleConfiguration>'
+                % u''.join(rules)).encode('utf-8')
+
+
+class _Batch(object):
+    ''' rules gathered for one write, and how that write went '''
+
+    def __init__(self):
+        self.rules = {}
+        self.written = False
+        self.error = None  # exc_info of a failed write
+
+
+class LifecycleManager(object):
+    ''' keeps a cached, parsed copy of the bucket's lifecycle configuration
+        and merges per folder expiration rules into it, instead of writing
+        a fresh configuration holding a single rule.
+
+        concurrent updates are coalesced: whichever caller gets to write
+        applies the pending rules of every other caller too, so a burst of
+        portal creations costs one GET and one PUT, and every caller gets
+        the outcome of the write holding its rules. rules not created by
+        the portal are preserved untouched. every write starts from a
+        fresh read of the configuration, so rules other processes added
+        are kept; the cached copy, reloaded once older than ttl seconds,
+        only serves lookups.
+
+        bucket is a callable returning a context manager that yields the
+        bucket to configure (see libs.utils.s3_bucket) '''
+
+    def __init__(self, bucket, base='uploads/', max_rules=MAX_RULES,
+                 ttl=30, delay=0):
+        self._bucket = bucket
+        self.base = base
+        self.max_rules = max_rules
+        self.ttl = ttl
+        self.delay = delay
+        self._config = None
+        self._loaded_at = 0
+        self._batch = _Batch()
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self.writes = 0
+
+    def _load(self, bucket):
+        ''' reads and parses the bucket's lifecycle configuration. boto's
+            Lifecycle only knows some rule elements and drops the rest
+            (filters, noncurrent version and incomplete upload actions),
+            so the xml is read directly '''
+        response = bucket.connection.make_request('GET', bucket.name,
+                                                  query_args='lifecycle')
+        body = response.read()
+        if response.status == 404:  # NoSuchLifecycleConfiguration
+            return _Config()
+        if response.status != 200:
+            raise S3ResponseError(response.status, response.reason, body)
+        config = _Config()
+        for xml in _RULE.findall(body.decode('utf-8')):
+            rule = _children(ElementTree.fromstring(xml.encode('utf-8')))
+            prefix = self._rule_prefix(rule)
+            if 'Filter' in rule:
+                config.filters = True
+            days = self._managed_days(rule, prefix)
+            if days is None:
+                config.foreign.append((xml, prefix))
+            else:
+                config.managed[prefix] = days
+        return config
+
+    def _rule_prefix(self, rule):
+        ''' the prefix a rule applies to; '' for every key '''
+        if 'Prefix' in rule:
+            return rule['Prefix'].text or ''
+        for element in rule.get('Filter', ()):
+            if _tag(element) == 'Prefix':
+                return element.text or ''
+            if _tag(element) == 'And':
+                for condition in element:
+                    if _tag(condition) == 'Prefix':
+                        return condition.text or ''
+        return ''
+
+    def _managed_days(self, rule, prefix):
+        ''' the expiration days of a rule created by the portal: a per
+            folder rule (id is the folder) or a consolidated rule, with
+            an enabled expiration after some days and nothing else. None
+            for any other rule '''
+        if set(rule) - set(['ID', 'Prefix', 'Filter', 'Status',
+                            'Expiration']):
+            return None
+        if 'Filter' in rule and \
+                [_tag(e) for e in rule['Filter']] != ['Prefix']:
+            return None
+        rule_id = rule['ID'].text if 'ID' in rule else None
+        if not prefix.startswith(self.base) or \
+                rule_id not in (prefix, prefix.rstrip('/'),
+                                CONSOLIDATED + prefix):
+            return None
+        if 'Status' not in rule or rule['Status'].text != 'Enabled':
+            return None
+        expiration = _children(rule.get('Expiration', ()))
+        if set(expiration) != set(['Days']):
+            return None
+        try:
+            return int(expiration['Days'].text)
+        except (TypeError, ValueError):
+            return None
+
+    def _current(self, bucket):
+        if self._config is None or time.time() - self._loaded_at > self.ttl:
+            self._config = self._load(bucket)
+            self._loaded_at = time.time()
+        return self._config
+
+    def rules(self):
+        ''' {prefix: expiration days} of the portal's rules, from the
+            cached configuration '''
+        with self._write_lock:
+            with self._bucket() as bucket:
+                config = self._current(bucket)
+        return dict(config.managed)
+
+    def expiration_days(self, directory, rules=None):
+        ''' days after which objects in directory expire, or None. pass
+            the result of rules() when looking up many folders '''
+        if rules is None:
+            rules = self.rules()
+        path = directory.rstrip('/') + '/'
+        for prefix, days in rules.items():
+            if path.startswith(prefix):
+                return days
+        return None
+
+    def set_expirations(self, rules):
+        ''' sets the expiration of each (directory, days) in rules and
+            writes them to the bucket, along with those of concurrent
+            callers. raises if that write fails, eg with ValueError when
+            the rules can't be made to fit; the rules are then dropped '''
+        with self._lock:
+            batch = self._batch
+            for directory, days in rules:
+                batch.rules[directory.rstrip('/')] = int(days)
+        self._flush(batch)
+
+    def _flush(self, batch):
+        ''' writes batch, unless another caller already has '''
+        with self._write_lock:
+            if not batch.written:
+                if self.delay:
+                    time.sleep(self.delay)  # let a burst of updates gather
+                with self._lock:
+                    self._batch = _Batch()
+                batch.written = True
+                try:
+                    self._write(batch.rules)
+                except:
+                    batch.error = sys.exc_info()
+            if batch.error is not None:
+                raise batch.error[0], batch.error[1], batch.error[2]
+
+    def _write(self, pending):
+        with self._bucket() as bucket:
+            # read right before writing, not from the cache, so rules
+            # written by other processes in the meantime are kept
+            config = self._merge(self._load(bucket), pending, bucket)
+            xml = config.to_xml()
+            md5 = boto.utils.compute_md5(StringIO(xml))
+            response = bucket.connection.make_request(
+                'PUT', bucket.name, data=xml, query_args='lifecycle',
+                headers={'Content-MD5': md5[1], 'Content-Type': 'text/xml'})
+            body = response.read()
+            if response.status != 200:
+                raise S3ResponseError(response.status, response.reason, body)
+        self._config = config
+        self._loaded_at = time.time()
+        self.writes += 1
+
+    def _folders_below(self, bucket, prefix):
+        return [p.name for p in bucket.list(prefix=prefix, delimiter='/')
+                if type(p) is Prefix]
+
+    def _names_below(self, bucket, prefix):
+        ''' the folders and loose keys a rule on prefix would expire '''
+        return [p.name for p in bucket.list(prefix=prefix, delimiter='/')]
+
+    def _merge(self, config, pending, bucket):
+        ''' returns config with pending applied '''
+        managed = dict(config.managed)
+        for directory, days in sorted(pending.items()):
+            path = directory + '/'
+            for prefix in managed.keys():
+                if prefix == path:
+                    continue
+                if path.startswith(prefix):
+                    # a consolidated (or legacy, unterminated) rule covers
+                    # this folder; split it back into per folder rules
+                    old = managed.pop(prefix)
+                    for folder in self._folders_below(bucket, prefix):
+                        managed.setdefault(folder, old)
+                elif prefix.startswith(path):
+                    del managed[prefix]
+            managed[path] = days
+
+        fixed = [prefix for xml, prefix in config.foreign]
+        managed = consolidate(managed, self.max_rules - len(config.foreign),
+                              self.base, fixed,
+                              lambda prefix: self._names_below(bucket,
+                                                               prefix))
+        return _Config(managed, config.foreign, config.filters)
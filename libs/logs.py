@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import sys
+import time
+import json
+import Queue
+import logging
+import threading
+from datetime import datetime
+
+# LogRecord attributes that aren't extra fields passed by the caller
+RESERVED = set(logging.LogRecord('', 0, '', 0, '', (), None).__dict__) | \
+    set(['message', 'asctime'])
+
+
+class JsonFormatter(logging.Formatter):
+    ''' formats records as one JSON object per line. fields passed with
+        logging's extra= are included as is '''
+
+    def format(self, record):
+        entry = {'time': datetime.utcfromtimestamp(record.created)
+                         .strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                 'level': record.levelname,
+                 'logger': record.name,
+                 'message': record.getMessage()}
+        for name, value in record.__dict__.items():
+            if name not in RESERVED:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        elif record.exc_text:  # formatted before it was queued
+            entry['exc_info'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class QueueHandler(logging.Handler):
+    ''' hands records to a background thread, so logging never blocks a
+        request on i/o. the message is rendered before queueing, as the
+        arguments could change before the record is written. when the
+        queue is full, records are dropped and counted '''
+
+    def __init__(self, handler, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.handler = handler
+        self.queue = Queue.Queue(maxsize)
+        self.dropped = 0
+        thread = threading.Thread(target=self._write, name='log-writer')
+        thread.daemon = True
+        thread.start()
+
+    def emit(self, record):
+        try:
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = self.handler.formatter.formatException(
+                    record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Queue.Full:
+            self.dropped += 1
+        except:
+            self.handleError(record)
+
+    def _write(self):
+        while True:
+            record = self.queue.get()
+            try:
+                self.handler.handle(record)
+            except:
+                pass
+
+    def flush(self):
+        ''' waits until queued records are written (best effort) '''
+        while not self.queue.empty():
+            time.sleep(0.01)
+        self.handler.flush()
+
+
+def queue_stdout_handler(level=logging.INFO):
+    ''' a QueueHandler writing JSON lines to stdout '''
+    stream = logging.StreamHandler(sys.stdout)
+    stream.setFormatter(JsonFormatter())
+    handler = QueueHandler(stream)
+    handler.setLevel(level)
+    return handler
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+
+import time
+import threading
+from functools import wraps
+from jinja2 import Template
+from boto.s3.connection import S3Connection
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+# upper bounds of the per request s3 call / listing page histograms
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 500)
+# s3 sub-resources that name an operation of their own
+SUBRESOURCES = ('uploads', 'uploadId', 'lifecycle', 'versioning', 'versions',
+                'acl', 'cors', 'policy', 'location', 'delete')
+
+
+def _escape(value):
+    return (unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def _labels(names, values, extra=''):
+    pairs = ['%s="%s"' % (n, _escape(v)) for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{%s}' % ','.join(pairs) if pairs else ''
+
+
+class Counter(object):
+    ''' a monotonically increasing count per combination of labels '''
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for labels, value in values:
+            yield '%s%s %s' % (self.name, _labels(self.labels, labels),
+                               repr(float(value)))
+
+
+class Histogram(object):
+    ''' counts of observations below fixed bucket bounds, per labels '''
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}  # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts = self._values.get(labels)
+            if counts is None:
+                counts = self._values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((k, list(v)) for k, v in self._values.items())
+        for labels, counts in values:
+            for bound, count in zip(self.buckets, counts):
+                yield '%s_bucket%s %d' % (
+                    self.name,
+                    _labels(self.labels, labels, 'le="%s"' % repr(bound)),
+                    count)
+            yield '%s_bucket%s %d' % (
+                self.name, _labels(self.labels, labels, 'le="+Inf"'),
+                counts[-1])
+            yield '%s_sum%s %s' % (self.name, _labels(self.labels, labels),
+                                   repr(float(counts[-2])))
+            yield '%s_count%s %d' % (self.name, _labels(self.labels, labels),
+                                     counts[-1])
+
+
+class Registry(object):
+    ''' the metrics of the process, rendered in the prometheus text
+        exposition format. collectors are callables returning extra
+        {name: (help, value)} gauges, read when rendering '''
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            lines.extend(metric.samples())
+        for collect in self.collectors:
+            for name, (help, value) in sorted(collect().items()):
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s gauge' % name)
+                lines.append('%s %s' % (name, repr(float(value))))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    'http_requests_total', 'HTTP requests handled',
+    ('endpoint', 'method', 'status')))
+http_latency = registry.register(Histogram(
+    'http_request_duration_seconds', 'Time to produce a response',
+    ('endpoint',)))
+http_bytes = registry.register(Counter(
+    'http_response_bytes_total', 'Bytes of response bodies sent',
+    ('endpoint',)))
+http_s3_calls = registry.register(Histogram(
+    'http_request_s3_calls', 'S3 requests made per HTTP request',
+    ('endpoint',), COUNT_BUCKETS))
+http_listing_pages = registry.register(Histogram(
+    'http_request_listing_pages', 'S3 LIST pages fetched per HTTP request',
+    ('endpoint',), COUNT_BUCKETS))
+s3_requests = registry.register(Counter(
+    's3_requests_total', 'S3 requests made', ('operation', 'status')))
+s3_latency = registry.register(Histogram(
+    's3_request_duration_seconds', 'Time to the response headers of an S3 '
+    'request', ('operation',)))
+operation_latency = registry.register(Histogram(
+    'operation_duration_seconds', 'Time spent in instrumented functions '
+    '(listings, page building, template rendering)', ('operation',)))
+
+_request = threading.local()
+
+
+class RequestCounts(object):
+    ''' the s3 calls and listing pages made for one request, by its own
+        thread and by the worker threads it hands functions wrapped with
+        bind_request to '''
+
+    def __init__(self):
+        self.started = time.time()
+        self.s3_calls = 0
+        self.listing_pages = 0
+        self._lock = threading.Lock()
+
+    def count(self, operation):
+        with self._lock:
+            self.s3_calls += 1
+            if operation == 'list':
+                self.listing_pages += 1
+
+
+def begin_request():
+    ''' starts counting the s3 calls made by this thread; returns the
+        request's counts '''
+    counts = _request.counts = RequestCounts()
+    return counts
+
+
+def current_request():
+    ''' the counts of the request this thread works for, or None '''
+    return getattr(_request, 'counts', None)
+
+
+def end_request(counts=None):
+    ''' stops counting and returns (seconds, s3 calls, listing pages)
+        since begin_request, for counts or else this thread's request '''
+    if counts is None:
+        counts = current_request()
+        if counts is None:
+            return 0, 0, 0
+    if current_request() is counts:
+        _request.counts = None
+    return (time.time() - counts.started, counts.s3_calls,
+            counts.listing_pages)
+
+
+def bind_request(func):
+    ''' wraps func so that the s3 calls it makes count towards the
+        current request, whichever thread it runs on. for functions
+        handed to thread pools '''
+    counts = current_request()
+    if counts is None:
+        return func
+
+    def wrapper(*args, **kwargs):
+        previous = current_request()
+        _request.counts = counts
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _request.counts = previous
+    return wrapper
+
+
+def s3_operation(method, key, query_args):
+    ''' a short name for an s3 request, eg list, get_object, put_uploadId '''
+    if query_args:
+        names = [arg.partition('=')[0] for arg in query_args.split('&')]
+        for sub in SUBRESOURCES:
+            if sub in names:
+                if sub == 'versions':
+                    return 'list'
+                return '%s_%s' % (method.lower(), sub)
+    if key:
+        return '%s_object' % method.lower()
+    if method == 'GET':
+        return 'list'
+    return '%s_bucket' % method.lower()
+
+
+class InstrumentedS3Connection(S3Connection):
+    ''' an S3Connection that times and counts every request it makes '''
+
+    def make_request(self, method, bucket='', key='', headers=None, data='',
+                     query_args=None, sender=None, override_num_retries=None,
+                     retry_handler=None):
+        operation = s3_operation(method, key, query_args)
+        started = time.time()
+        status = 'error'
+        try:
+            response = S3Connection.make_request(
+                self, method, bucket, key, headers, data, query_args, sender,
+                override_num_retries, retry_handler)
+            status = str(response.status)
+            return response
+        finally:
+            s3_latency.observe(time.time() - started, operation)
+            s3_requests.inc(1, operation, status)
+            counts = current_request()
+            if counts is not None:
+                counts.count(operation)
+
+
+def timed(operation):
+    ''' decorator recording the run time of a function. for generator
+        functions, the time until the generator is exhausted or closed '''
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                operation_latency.observe(time.time() - started, operation)
+
+        @wraps(func)
+        def generator_wrapper(*args, **kwargs):
+            started = time.time()
+            try:
+                for item in func(*args, **kwargs):
+                    yield item
+            finally:
+                operation_latency.observe(time.time() - started, operation)
+
+        if func.func_code.co_flags & 0x20:  # CO_GENERATOR
+            return generator_wrapper
+        return wrapper
+    return decorate
+
+
+class TimedTemplate(Template):
+    ''' jinja template class recording the time every render takes; set
+        as an environment's template_class '''
+
+    def render(self, *args, **kwargs):
+        started = time.time()
+        try:
+            return Template.render(self, *args, **kwargs)
+        finally:
+            operation_latency.observe(time.time() - started,
+                                      'render:%s' % self.name)
+
+
+class CountedBody(object):
+    ''' passes the chunks of a streamed response through, counting them
+        towards the endpoint's response bytes. finish(bytes sent) is
+        called once the body has been sent or closed, so that the work
+        done producing it is part of the request '''
+
+    def __init__(self, iterable, endpoint, finish=None):
+        self.iterable = iterable
+        self.endpoint = endpoint
+        self.finish = finish
+        self.sent = 0
+        self.closed = False
+
+    def __iter__(self):
+        for chunk in self.iterable:
+            self.sent += len(chunk)
+            yield chunk
+        self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            close = getattr(self.iterable, 'close', None)
+            if close is not None:
+                close()
+        finally:
+            http_bytes.inc(self.sent, self.endpoint)
+            if self.finish is not None:
+                self.finish(self.sent)
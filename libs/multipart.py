@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+import xml.sax
+from boto import handler
+from boto.exception import S3ResponseError
+from boto.s3.multipart import MultiPartUpload
+from libs.utils import s3_bucket
+from libs.utils import verify_policy
+from libs.utils import presign_s3_url
+from libs.utils import invalidate_listings
+
+# s3 multipart limits
+MIN_PART_SIZE = 5 * 1024 * 1024  # of every part but the last
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+PART_URL_LIFETIME = 60 * 60  # seconds a presigned part url is valid for
+
+
+class PortalUpload(object):
+    ''' multipart uploads on behalf of a customer portal.
+
+        the portal's signed POST policy doubles as its credential: every
+        call must present it, and the policy's key prefix, size limit and
+        expiration are enforced on the upload. parts are PUT straight to
+        s3 by the browser through presigned urls; the app never sees the
+        data, only the listing of the uploaded parts when completing '''
+
+    def __init__(self, bucket_name, access_key, secret_key, policy,
+                 signature):
+        self.bucket_name = bucket_name
+        self.access_key = access_key
+        self.secret_key = secret_key
+        document = verify_policy(policy, signature, secret_key)
+        self.directory = None
+        self.max_byte_size = None
+        for condition in document['conditions']:
+            if isinstance(condition, list):
+                if condition[0] == 'starts-with' and condition[1] == '$key':
+                    self.directory = condition[2]
+                elif condition[0] == 'content-length-range':
+                    self.max_byte_size = int(condition[2])
+        if not self.directory:
+            raise ValueError('Policy does not restrict the key')
+
+    def check_key(self, keyname):
+        ''' raises ValueError unless keyname is inside the portal folder '''
+        filename = keyname[len(self.directory):]
+        if not keyname.startswith(self.directory) or \
+                filename in ('', '.', '..'):
+            raise ValueError('Invalid key for this upload link')
+        return keyname
+
+    def create(self, filename):
+        ''' starts a multipart upload of filename, with the server side
+            encryption the portal's policy requires. returns (key, id) '''
+        keyname = self.check_key(self.directory + filename)
+        with s3_bucket(self.bucket_name) as bucket:
+            mp = bucket.initiate_multipart_upload(keyname, encrypt_key=True,
+                                                  policy='private')
+        return keyname, mp.id
+
+    def part_url(self, keyname, upload_id, part_number, offset, size, total):
+        ''' presigned url to PUT part part_number of the upload: size bytes
+            at offset of a file of total bytes. a presigned url can't bind
+            the length of the part, so these are what the browser declares;
+            complete() checks the parts s3 actually received '''
+        self.check_key(keyname)
+        part_number, offset, size, total = (int(part_number), int(offset),
+                                            int(size), int(total))
+        if not 1 <= part_number <= MAX_PARTS:
+            raise ValueError('Invalid part number')
+        if offset < 0 or not 0 <= size <= MAX_PART_SIZE or \
+                offset + size > total or (size == 0 and total > 0):
+            raise ValueError('Invalid part size')
+        if offset + size < total and size < MIN_PART_SIZE:
+            raise ValueError('Only the last part may be smaller than %d MiB'
+                             % (MIN_PART_SIZE / (1024 * 1024)))
+        if self.max_byte_size is not None and total > self.max_byte_size:
+            raise ValueError('File is larger than this upload link allows')
+        return presign_s3_url('PUT', self.bucket_name, keyname,
+                              self.access_key, self.secret_key,
+                              PART_URL_LIFETIME,
+                              {'partNumber': part_number,
+                               'uploadId': upload_id})
+
+    def _upload(self, bucket, keyname, upload_id):
+        mp = MultiPartUpload(bucket)
+        mp.key_name = keyname
+        mp.id = upload_id
+        return mp
+
+    def _list_parts(self, mp, marker=None):
+        ''' one page of the parts of mp. boto's get_all_parts returns None
+            instead of raising when s3 answers with an error, eg for an
+            unknown or finished upload id '''
+        query_args = 'uploadId=%s' % mp.id
+        if marker:
+            query_args += '&part-number-marker=%s' % marker
+        response = mp.bucket.connection.make_request(
+            'GET', mp.bucket.name, mp.key_name, query_args=query_args)
+        body = response.read()
+        if response.status != 200:
+            raise S3ResponseError(response.status, response.reason, body)
+        mp._parts = []
+        xml.sax.parseString(body, handler.XmlHandler(mp, mp))
+        return mp._parts
+
+    def parts(self, keyname, upload_id):
+        ''' the parts uploaded so far, as a list of (number, size, etag).
+            raises S3ResponseError (404) if there is no such upload '''
+        self.check_key(keyname)
+        parts = []
+        with s3_bucket(self.bucket_name) as bucket:
+            mp = self._upload(bucket, keyname, upload_id)
+            marker = None
+            while True:
+                parts.extend((p.part_number, int(p.size), p.etag)
+                             for p in self._list_parts(mp, marker))
+                if not mp.is_truncated:
+                    return parts
+                marker = mp.next_part_number_marker
+
+    def complete(self, keyname, upload_id):
+        ''' assembles the uploaded parts into the final object. the upload
+            is aborted if it exceeds the portal's size limit. returns the
+            size of the object '''
+        parts = self.parts(keyname, upload_id)
+        size = sum(p[1] for p in parts)
+        if not parts:
+            raise ValueError('No parts have been uploaded')
+        if self.max_byte_size is not None and size > self.max_byte_size:
+            self.abort(keyname, upload_id)
+            raise ValueError('File is larger than this upload link allows')
+        xml = '<CompleteMultipartUpload>\n'
+        for number, _, etag in parts:
+            xml += ('  <Part>\n'
+                    '    <PartNumber>%d</PartNumber>\n'
+                    '    <ETag>%s</ETag>\n'
+                    '  </Part>\n') % (number, etag)
+        xml += '</CompleteMultipartUpload>'
+        with s3_bucket(self.bucket_name) as bucket:
+            bucket.complete_multipart_upload(keyname, upload_id, xml)
+        invalidate_listings(keyname)
+        return size
+
+    def abort(self, keyname, upload_id):
+        ''' discards the upload and its parts '''
+        self.check_key(keyname)
+        with s3_bucket(self.bucket_name) as bucket:
+            bucket.cancel_multipart_upload(keyname, upload_id)
@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+
+import os
+import re
+import csv
+import json
+import threading
+from datetime import datetime
+from multiprocessing.pool import ThreadPool
+from jinja2 import Environment
+from jinja2 import FileSystemLoader
+from jinja2 import FileSystemBytecodeCache
+from libs.utils import gen_policy
+from libs.utils import sign_policy
+from libs.utils import valid_name
+from libs.utils import upload_s3
+from libs.utils import static_assets_url
+from libs.utils import create_folders_and_lifecycle
+from libs.metrics import timed
+from libs.metrics import bind_request
+from libs.metrics import TimedTemplate
+
+# columns of a batch file; the same names as the generate_form form fields
+PORTAL_FIELDS = ['directory', 'lifecycle', 'exp', 'maxupload', 'notes',
+                 'multipart']
+MAX_POST_SIZE = 5 * 1024 ** 3  # largest single POST upload s3 accepts
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'templates')
+
+# values of upload.html that differ between portals sharing the same
+# bucket/app settings; everything else is rendered once per PortalPage
+PAGE_FIELDS = ('policy', 'signature', 'directory', 'max_in_megs', 'notes')
+PLACEHOLDER = u'\x00portal:%s\x00'
+PLACEHOLDER_RE = re.compile(u'\x00portal:(\\w+)\x00')
+MAX_PAGES = 64
+
+_template_env = None
+_template_env_lock = threading.Lock()
+_pages = {}
+_pages_lock = threading.Lock()
+
+
+def get_template_env():
+    ''' returns the process wide jinja environment for the portal pages.
+        compiled templates are kept in a bytecode cache (TEMPLATE_CACHE_DIR,
+        default a per user temp dir) so even a fresh process doesn't parse
+        them. templates aren't checked for changes unless
+        TEMPLATE_AUTO_RELOAD is set, eg while editing them '''
+    global _template_env
+    if _template_env is None:
+        with _template_env_lock:
+            if _template_env is None:
+                cache_dir = os.environ.get('TEMPLATE_CACHE_DIR')
+                if cache_dir and not os.path.isdir(cache_dir):
+                    os.makedirs(cache_dir)
+                auto_reload = os.environ.get('TEMPLATE_AUTO_RELOAD', '')
+                _template_env = Environment(
+                    loader=FileSystemLoader(TEMPLATE_DIR),
+                    bytecode_cache=FileSystemBytecodeCache(cache_dir),
+                    auto_reload=auto_reload.lower() in ('1', 'true', 'yes'))
+                _template_env.template_class = TimedTemplate
+    return _template_env
+
+
+class PortalPage(object):
+    ''' upload.html pre-rendered for the settings shared by many portals,
+        split around placeholders for the PAGE_FIELDS. filling in a portal
+        only joins strings instead of running the template.
+
+        the template shows the notes block only for notes longer than one
+        character, so a variant is kept with and without it '''
+
+    def __init__(self, template, **shared):
+        self.variants = {}
+        for with_notes in (True, False):
+            values = dict(shared)
+            for field in PAGE_FIELDS:
+                values[field] = PLACEHOLDER % field
+            if not with_notes:
+                values['notes'] = u''
+            self.variants[with_notes] = PLACEHOLDER_RE.split(
+                template.render(**values))
+
+    def render(self, **values):
+        parts = list(self.variants[len(values['notes']) > 1])
+        for i in range(1, len(parts), 2):  # odd items are field names
+            parts[i] = unicode(values[parts[i]])
+        return u''.join(parts)
+
+
+def portal_page(bucket_name, access_key, multipart, api_root):
+    ''' the PortalPage for these settings, built on first use '''
+    env = get_template_env()
+    shared = dict(bucket_name=bucket_name,
+                  access_key=access_key,
+                  static_url=static_assets_url(bucket_name),
+                  multipart=multipart,
+                  api_root=api_root)
+    if env.auto_reload:
+        return PortalPage(env.get_template('upload.html'), **shared)
+    key = tuple(sorted(shared.items()))
+    page = _pages.get(key)
+    if page is None:
+        page = PortalPage(env.get_template('upload.html'), **shared)
+        with _pages_lock:
+            if len(_pages) >= MAX_PAGES:  # api_root comes from the request
+                _pages.clear()
+            _pages[key] = page
+    return page
+
+
+def parse_portal(fields, prefix='uploads/'):
+    ''' validates one portal request, a dict of PORTAL_FIELDS, the same way
+        generate_form does. returns the portal params; raises ValueError '''
+    if not isinstance(fields, dict):
+        raise ValueError('Invalid portal: expected an object')
+    try:
+        lifecycle = int(fields['lifecycle'])
+        assert lifecycle <= 180
+    except:
+        raise ValueError('Invalid Lifecycle Duration')
+
+    try:
+        exp = datetime.strptime(fields['exp'], '%Y-%m-%d').isoformat() + 'Z'
+    except:
+        raise ValueError('Invalid Expiration Date')
+
+    try:
+        maxupload = int(fields['maxupload'])
+    except:
+        raise ValueError('Invalid File Size')
+
+    directory = fields.get('directory') or ''
+    if directory == '' or not valid_name(directory):
+        raise ValueError('Invalid/Empty Name for Customer/Identifier. '
+                         '\'A-Z\', \'0-9\', \'-\' and \'_\' only.')
+
+    multipart = str(fields.get('multipart') or '').lower()
+    return {'directory': prefix + directory,
+            'lifecycle': lifecycle,
+            'exp': exp,
+            'maxupload': maxupload,
+            'notes': fields.get('notes') or '',
+            'multipart': (multipart in ('on', 'true', 'yes', '1') or
+                          maxupload > MAX_POST_SIZE)}
+
+
+def read_portal_specs(fp, filename=''):
+    ''' reads portal requests from fp: a JSON list of objects, or a CSV
+        file with a header row naming the PORTAL_FIELDS columns '''
+    data = fp.read()
+    if filename.lower().endswith('.json') or data.lstrip().startswith('['):
+        specs = json.loads(data)
+        if not isinstance(specs, list) or \
+                not all(isinstance(spec, dict) for spec in specs):
+            raise ValueError('Expected a JSON list of portal objects')
+        return specs
+    return list(csv.DictReader(data.splitlines()))
+
+
+@timed('render_portal')
+def render_portal_page(bucket_name, access_key, policy, signature, portal,
+                       api_root=None):
+    ''' renders the upload page of portal for a signed policy.
+        multipart portals call the application at api_root '''
+    if portal['multipart'] and not api_root:
+        raise ValueError('Multipart portals need the application url')
+    page = portal_page(bucket_name, access_key, portal['multipart'],
+                       api_root)
+    return page.render(policy=policy,
+                       signature=signature,
+                       max_in_megs=portal['maxupload'] / (1024 * 1024),
+                       notes=portal['notes'],
+                       directory=portal['directory'])
+
+
+def render_portal(bucket_name, access_key, secret_key, portal,
+                  api_root=None):
+    ''' signs the upload policy of portal and renders its upload page '''
+    policy = gen_policy(bucket_name=bucket_name,
+                        expiration=portal['exp'],
+                        max_byte_size=portal['maxupload'],
+                        directory=portal['directory'])
+    signature, policy = sign_policy(policy=policy, secret=secret_key)
+    return render_portal_page(bucket_name, access_key, policy, signature,
+                              portal, api_root)
+
+
+def create_portals(specs, bucket_name, access_key, secret_key,
+                   prefix='uploads/', api_root=None, workers=None):
+    ''' creates an upload portal for each of specs (see parse_portal).
+        pages are rendered and signed up front, the lifecycle rules of all
+        portals are applied with a single configuration write, and the
+        pages are uploaded on BATCH_UPLOAD_WORKERS threads.
+
+        returns a manifest with one entry per spec, in order: the portal's
+        directory and url, or the error that prevented its creation '''
+    if workers is None:
+        workers = int(os.environ.get('BATCH_UPLOAD_WORKERS', 8))
+
+    manifest = []
+    portals = []
+    for spec in specs:
+        try:
+            portal = parse_portal(spec, prefix)
+        except ValueError as e:
+            directory = spec.get('directory') \
+                if isinstance(spec, dict) else None
+            manifest.append({'directory': directory,
+                             'error': str(e)})
+            continue
+        entry = {'directory': portal['directory'][len(prefix):]}
+        manifest.append(entry)
+        portals.append((entry, portal))
+
+    pages = []
+    for entry, portal in portals:
+        try:
+            pages.append((entry, render_portal(bucket_name, access_key,
+                                               secret_key, portal, api_root)))
+        except Exception as e:
+            entry['error'] = 'Error rendering template: %s' % e
+
+    # later specs for the same directory win, as if posted one by one
+    rules = dict((portal['directory'], portal['lifecycle'])
+                 for entry, portal in portals if 'error' not in entry)
+    error = create_folders_and_lifecycle(bucket_name, rules.items())
+    if error:
+        for entry in manifest:
+            entry.setdefault('error', error)
+        return manifest
+
+    def upload(page):
+        entry, html = page
+        url = upload_s3(contents=html, bucket_name=bucket_name)
+        if url is None:
+            entry['error'] = 'Error uploading to s3'
+        else:
+            # strip signature from url; we dont need since the form is public
+            entry['url'] = url.split('?')[0]
+
+    if pages:
+        pool = ThreadPool(min(workers, len(pages)))
+        try:
+            pool.map(bind_request(upload), pages)
+        finally:
+            pool.close()
+    return manifest
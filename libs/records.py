@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+import urllib2
+from datetime import datetime
+from collections import namedtuple
+
+# picklable records of a bucket listing; attribute names match boto's Key
+S3Version = namedtuple('S3Version', 'name version_id last_modified size')
+S3Folder = namedtuple('S3Folder', 'name')
+
+
+def parse_timestamp(value):
+    ''' parses an s3 listing timestamp, eg 2015-06-01T12:30:00.000Z, much
+        faster than strptime. fractional seconds are dropped, as before '''
+    return datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                    int(value[11:13]), int(value[14:16]), int(value[17:19]))
+
+
+def format_size(size):
+    ''' size in bytes as the MiB string shown in the listings '''
+    return '%.2f' % (size / 1048576.0)
+
+
+def url_token(value):
+    ''' encodes value for the keyname/version params of a /gendl link '''
+    return urllib2.quote(value.encode('base64').rstrip())
+
+
+class FileRow(object):
+    ''' one row of the file table, built from an S3Version. only the raw
+        listing fields are stored; the date, size string and download
+        link tokens are computed when first used, so rows that are only
+        sorted or skipped cost next to nothing. supports row['name'] as
+        well as row.name, like the dicts it replaces '''
+
+    __slots__ = ('_version', 'key', 'dir', 'name', '_date')
+
+    def __init__(self, version, prefix):
+        self._version = version
+        self.key = version.name[len(prefix):]
+        self.dir, _, self.name = self.key.partition('/')
+        self._date = None
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def v_id(self):
+        return self._version.version_id
+
+    @property
+    def last_modified(self):
+        return self._version.last_modified
+
+    @property
+    def bytes(self):
+        return self._version.size
+
+    @property
+    def date(self):
+        if self._date is None:
+            self._date = parse_timestamp(self._version.last_modified)
+        return self._date
+
+    @property
+    def size(self):
+        return format_size(self._version.size)
+
+    @property
+    def cb64(self):
+        return url_token(self._version.name)
+
+    @property
+    def vb64(self):
+        return url_token(self._version.version_id)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+
+import threading
+import Queue
+import urlparse
+from boto.s3.connection import OrdinaryCallingFormat
+from libs.metrics import InstrumentedS3Connection
+from contextlib import contextmanager
+
+
+class S3Pool(object):
+    ''' thread-safe, size bounded pool of s3 connections.
+
+        each pooled connection keeps its own bucket handles, so a checkout
+        costs no network I/O once the pool is warm. a bucket is validated
+        (HEAD bucket) the first time it is requested by the process only;
+        every later handle is built with validate=False.
+
+        endpoint, eg http://localhost:9000, points the connections at an
+        s3 compatible server instead of aws, with path style addressing '''
+
+    def __init__(self, access_key, secret_key, size=10, timeout=30,
+                 endpoint=None):
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.endpoint = endpoint
+        self.size = size
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue(maxsize=size)
+        self._lock = threading.Lock()
+        self._created = 0
+        self._validated = set()
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def _connect(self):
+        options = {}
+        if self.endpoint:
+            url = urlparse.urlparse(self.endpoint)
+            options = {'host': url.hostname,
+                       'port': url.port,
+                       'is_secure': url.scheme == 'https',
+                       'calling_format': OrdinaryCallingFormat()}
+        s3 = InstrumentedS3Connection(aws_access_key_id=self.access_key,
+                                      aws_secret_access_key=self.secret_key,
+                                      **options)
+        s3.pooled_buckets = {}
+        return s3
+
+    def acquire(self):
+        ''' check a connection out of the pool, creating one if the pool
+            has not reached its size yet; otherwise wait for a release '''
+        try:
+            s3 = self._idle.get_nowait()
+            with self._lock:
+                self.hits += 1
+            return s3
+        except Queue.Empty:
+            pass
+
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+                self.misses += 1
+            else:
+                self.waits += 1
+        if create:
+            try:
+                return self._connect()
+            except:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            s3 = self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise RuntimeError('Timed out waiting for a pooled s3 connection')
+        with self._lock:
+            self.hits += 1
+        return s3
+
+    def release(self, s3):
+        ''' return a connection to the pool '''
+        try:
+            self._idle.put_nowait(s3)
+        except Queue.Full:
+            with self._lock:
+                self._created -= 1
+
+    def get_bucket(self, s3, bucket_name):
+        ''' returns the cached bucket handle of connection s3 '''
+        bucket = s3.pooled_buckets.get(bucket_name)
+        if bucket is None:
+            validate = bucket_name not in self._validated
+            bucket = s3.get_bucket(bucket_name, validate=validate)
+            self._validated.add(bucket_name)
+            s3.pooled_buckets[bucket_name] = bucket
+        return bucket
+
+    def mark_validated(self, bucket_name):
+        ''' record that bucket_name is known to exist (eg, just created) '''
+        self._validated.add(bucket_name)
+
+    @contextmanager
+    def connection(self):
+        s3 = self.acquire()
+        try:
+            yield s3
+        finally:
+            self.release(s3)
+
+    @contextmanager
+    def bucket(self, bucket_name):
+        with self.connection() as s3:
+            yield self.get_bucket(s3, bucket_name)
+
+    def stats(self):
+        ''' pool counters, for monitoring '''
+        with self._lock:
+            return {'size': self.size,
+                    'created': self._created,
+                    'idle': self._idle.qsize(),
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'waits': self.waits}
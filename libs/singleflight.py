@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+import sys
+import threading
+
+
+class Call(object):
+    ''' one in-flight call; followers wait on it for the leader's result '''
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None  # exc_info of a failed call
+        self.followers = 0
+
+    def result(self):
+        ''' waits for the leader and returns its value, or raises its
+            exception '''
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.value
+
+
+class SingleFlight(object):
+    ''' coalesces concurrent identical calls within the process: while a
+        call for a key is in flight, later callers for the same key wait
+        for it and share its result instead of making the call again.
+        nothing is kept once the call returns; caching is left to the
+        caller.
+
+        do() covers plain functions. work that streams its result (a
+        listing yielded page by page) uses begin() and finish() directly,
+        so the leader can hand out records while followers wait for the
+        complete result '''
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.leaders = 0
+        self.followers = 0
+
+    def begin(self, key):
+        ''' returns (call, leader). the leader must make the call and
+            pass its outcome to finish, whatever happens; everyone else
+            gets it from call.result() '''
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.followers += 1
+                self.followers += 1
+                return call, False
+            call = self._calls[key] = Call()
+            self.leaders += 1
+            return call, True
+
+    def finish(self, key, call, value=None, error=None):
+        ''' records the outcome of the leader's call and wakes the
+            followers. error is the exc_info of a failed call '''
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        call.value = value
+        call.error = error
+        call.done.set()
+
+    def do(self, key, func, *args, **kwargs):
+        ''' func(*args, **kwargs), unless a call for key is in flight
+            already, in which case its result is returned instead '''
+        call, leader = self.begin(key)
+        if not leader:
+            return call.result()
+        try:
+            value = func(*args, **kwargs)
+        except:
+            self.finish(key, call, error=sys.exc_info())
+            raise
+        self.finish(key, call, value)
+        return value
+
+    def stats(self):
+        ''' calls made, and calls that shared another's result '''
+        with self._lock:
+            return {'calls': self.leaders,
+                    'shared': self.followers,
+                    'in_flight': len(self._calls)}
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+import os
+import time
+import threading
+from datetime import datetime
+from datetime import timedelta
+from libs.cache import ListingCache
+from libs.records import parse_timestamp
+from libs.records import format_size
+from libs.utils import get_object_index
+from libs.utils import get_lifecycle_manager
+from libs.utils import iter_s3_versions
+from libs.metrics import timed
+from libs.singleflight import SingleFlight
+
+_scans = None
+_scans_lock = threading.Lock()
+_scan_flights = SingleFlight()
+
+
+def _listing_stats(prefix):
+    ''' folder rollups computed from a full listing of prefix, for when
+        there is no object index to read them from '''
+    stats = {}
+    keys = set()
+    for f in iter_s3_versions(prefix):
+        folder, sep, _ = f.name[len(prefix):].partition('/')
+        if not sep:
+            continue  # not inside a portal folder
+        objects, versions, size, newest = stats.get(folder, (0, 0, 0, ''))
+        if f.name not in keys:
+            keys.add(f.name)
+            objects += 1
+        stats[folder] = (objects, versions + 1, size + f.size,
+                         max(newest, f.last_modified))
+    return stats
+
+
+def get_scan_cache():
+    ''' returns the cache of rollups computed by listing, kept for
+        STATS_SCAN_TTL seconds '''
+    global _scans
+    if _scans is None:
+        with _scans_lock:
+            if _scans is None:
+                _scans = ListingCache(
+                    ttl=float(os.environ.get('STATS_SCAN_TTL', 600)),
+                    max_entries=16)
+    return _scans
+
+
+def _scan(prefix):
+    scan = (time.time(), _listing_stats(prefix))
+    get_scan_cache().set(prefix, prefix, scan)
+    return scan
+
+
+def scanned_stats(prefix):
+    ''' (time, rollups) of the last full listing of prefix. a listing is
+        reused for STATS_SCAN_TTL seconds, and concurrent requests share
+        the one in flight, so the bucket isn't listed for every view '''
+    scan = get_scan_cache().get(prefix)
+    if scan is None:
+        scan = _scan_flights.do(prefix, _scan, prefix)
+    return scan
+
+
+@timed('folder_usage')
+def folder_usage(prefix, bucket_name):
+    ''' storage used by each portal folder under prefix, as (usage,
+        as_of). usage is a list of dicts sorted by folder: object and
+        version counts, bytes of all versions, the newest upload, and the
+        folder's lifecycle expiration with the date the newest upload
+        expires on.
+
+        read from the object index's folder rollups, which are updated as
+        versions come and go, and returned with an as_of of None. without
+        an index they come from a listing of every version, which is
+        reused for a while; as_of is then the time of that listing '''
+    index = get_object_index()
+    if index is not None and index.covers(prefix):
+        stats, as_of = index.folder_stats(), None
+    else:
+        scanned, stats = scanned_stats(prefix)
+        as_of = datetime.utcfromtimestamp(scanned)
+
+    manager = get_lifecycle_manager(bucket_name)
+    rules = manager.rules()
+    usage = []
+    for folder in sorted(stats):
+        objects, versions, size, newest = stats[folder]
+        newest = parse_timestamp(newest) if newest else None
+        days = manager.expiration_days(prefix + folder, rules)
+        expires_by = None
+        if days is not None and newest is not None:
+            expires_by = newest + timedelta(days=days)
+        usage.append({'folder': folder,
+                      'objects': objects,
+                      'versions': versions,
+                      'bytes': int(size),
+                      'size': format_size(size),
+                      'newest': newest,
+                      'expiration_days': days,
+                      'expires_by': expires_by})
+    return usage, as_of
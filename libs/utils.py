@@ -9,20 +9,61 @@ import uuid
 import string
 import os
 import json
+import urllib
 import urllib2
 import logging
-from boto.s3.lifecycle import Lifecycle
+import threading
+import time
+from multiprocessing.pool import ThreadPool
 from datetime import datetime
 from datetime import timedelta
 from boto.exception import S3ResponseError
+from boto.s3.prefix import Prefix
+from libs.s3pool import S3Pool
+from libs.logs import queue_stdout_handler
+from libs.metrics import timed
+from libs.metrics import bind_request
+from libs.cache import cache_from_env
+from libs.cache import ListingCache
+from libs.index import ObjectIndex
+from libs.lifecycle import LifecycleManager
+from libs.records import S3Version
+from libs.records import S3Folder
+from libs.records import FileRow
+from libs.records import parse_timestamp
+from libs.records import format_size
+from libs.records import url_token
+from libs.singleflight import SingleFlight
+
+_log_handler = None
+_s3_pool = None
+_s3_pool_lock = threading.Lock()
+_listing_cache = None
+_listing_cache_lock = threading.Lock()
+_url_cache = None
+_url_cache_lock = threading.Lock()
+_object_index = None
+_object_index_lock = threading.Lock()
+_static_manifests = {}
+_lifecycle_managers = {}
+_lifecycle_managers_lock = threading.Lock()
+# identical listing, HEAD and signing calls in flight at the same time
+# share one s3 request
+_flights = SingleFlight()
+
+# published static assets never change under a given versioned prefix
+ASSET_CACHE_CONTROL = 'public, max-age=31536000, immutable'
 
 
 def setup_logging():
-
-    logging.basicConfig(filename='httpsdropbox.log',
-                        format='[%(asctime)s] [%(levelname)s] - %(message)s',
-                        datefmt='%Y-%m-%d %H:%M:%S',
-                        level=logging.INFO)
+    ''' sends log records to stdout as JSON lines, written by a background
+        thread so requests never wait on the log '''
+    global _log_handler
+    if _log_handler is None:
+        _log_handler = queue_stdout_handler()
+        root = logging.getLogger()
+        root.addHandler(_log_handler)
+        root.setLevel(logging.INFO)
     return logging
 
 
@@ -34,40 +75,109 @@ def dt_to_string(dt):
 def init():
     ''' initialize the bucket'''
 
+    started = time.time()
     try:
-        ak, sk = get_env_creds()
         bucket_name = os.environ['BUCKET']
         if '.' in bucket_name:
             print ('WARNING: You will get SSL errors with a "." '
                    'in a bucket name - this is because the bucket name will'
                    ' appear as a subdomain of amazon. We highly encourage you'
                    ' to chose a bucket name without a dot in it')
-        s3 = boto.connect_s3(aws_access_key_id=ak,
-                             aws_secret_access_key=sk)
-        bucket = s3.get_bucket(bucket_name)
-        bucket.configure_versioning(True)
-    except S3ResponseError:
-        # bucket doesn't exist, let's create it
-        bucket = s3.create_bucket(bucket_name)
-        bucket.configure_versioning(True)
+        pool = get_s3_pool()
+        with pool.connection() as s3:
+            try:
+                bucket = pool.get_bucket(s3, bucket_name)
+            except S3ResponseError:
+                # bucket doesn't exist, let's create it
+                bucket = s3.create_bucket(bucket_name)
+                pool.mark_validated(bucket_name)
+                s3.pooled_buckets[bucket_name] = bucket
+            bucket.configure_versioning(True)
     except:
         print 'Could not create bucket: Error: %s' % (str(sys.exc_info()))
         raise
 
-    # upload all the static resources (js, css) and make public
+    # upload all the static resources (js, css) used by the upload
+    # forms, once, under a content-hashed prefix and make them public
     try:
-        k = boto.s3.key.Key(bucket)
-        for prefix in ['', 'upload_forms/']:
-            files = getFilePaths('static')
-            for f in files:
-                key = prefix + str(f)
-                if not bucket.get_key(key):
-                    k.key = key
-                    k.set_contents_from_filename(f)
-                    k.make_public()
+        uploaded, current = sync_static(bucket_name)
     except S3ResponseError:
         print 'Could not upload static resources. Error: %s' % (str(sys.exc_info()))
         raise
+    print ('init: %d static files uploaded, %d already current; startup took'
+           ' %.2fs' % (uploaded, current, time.time() - started))
+
+
+def file_md5(path):
+    ''' hex md5 of the file at path, as s3 reports it in a key's etag '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(64 * 1024), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def static_manifest(directory='static'):
+    ''' {path relative to directory: hex md5} of every file under
+        directory; computed once per process '''
+    if directory not in _static_manifests:
+        _static_manifests[directory] = dict(
+            (os.path.relpath(f, directory), file_md5(f))
+            for f in getFilePaths(directory))
+    return _static_manifests[directory]
+
+
+def static_assets_prefix(directory='static'):
+    ''' key prefix the static assets are published under. it embeds a
+        hash of the whole tree, so it changes whenever any asset does and
+        the published copies can be cached forever '''
+    return 'assets/%s/' % tree_version(directory)
+
+
+def tree_version(directory):
+    ''' short hash of the contents of every file under directory '''
+    manifest = static_manifest(directory)
+    return hashlib.md5(json.dumps(sorted(manifest.items()))).hexdigest()[:12]
+
+
+def static_assets_url(bucket_name, directory='static'):
+    ''' public url of the published static assets, without trailing / '''
+    return 'https://%s.s3.amazonaws.com/%s' % (
+        bucket_name, static_assets_prefix(directory).rstrip('/'))
+
+
+@timed('sync_static')
+def sync_static(bucket_name, directory='static', workers=None):
+    ''' publishes every file under directory below static_assets_prefix,
+        with headers that let browsers and CDNs cache them for good. local
+        md5s are compared with the etags of one LIST, and only missing or
+        changed files are uploaded, in parallel on STATIC_SYNC_WORKERS
+        threads. returns the counts of (uploaded, already current) files '''
+    if workers is None:
+        workers = int(os.environ.get('STATIC_SYNC_WORKERS', 8))
+    local = static_manifest(directory)
+    prefix = static_assets_prefix(directory)
+
+    with s3_bucket(bucket_name) as bucket:
+        remote = dict((k.name, k.etag.strip('"'))
+                      for k in bucket.list(prefix=prefix))
+    todo = [f for f, md5 in local.items() if remote.get(prefix + f) != md5]
+
+    def upload(f):
+        with s3_bucket(bucket_name) as bucket:
+            k = boto.s3.key.Key(bucket, prefix + f)
+            k.set_contents_from_filename(os.path.join(directory, f),
+                                         headers={'Cache-Control':
+                                                  ASSET_CACHE_CONTROL},
+                                         policy='public-read')
+
+    if todo:
+        pool = ThreadPool(min(workers, len(todo)))
+        try:
+            pool.map(bind_request(upload), todo)
+        finally:
+            pool.close()
+    return len(todo), len(local) - len(todo)
 
 
 def getFilePaths(directory):
@@ -87,6 +197,271 @@ def get_env_creds():
                         % str(sys.exc_info()))
 
 
+def get_s3_pool():
+    ''' returns the process wide s3 connection pool, creating it on
+        first use. size is read from the S3_POOL_SIZE env var, and
+        S3_ENDPOINT may name an s3 compatible server to use instead of
+        aws '''
+    global _s3_pool
+    if _s3_pool is None:
+        with _s3_pool_lock:
+            if _s3_pool is None:
+                ak, sk = get_env_creds()
+                size = int(os.environ.get('S3_POOL_SIZE', 10))
+                _s3_pool = S3Pool(ak, sk, size=size,
+                                  endpoint=os.environ.get('S3_ENDPOINT'))
+    return _s3_pool
+
+
+def s3_bucket(bucket_name=None):
+    ''' context manager yielding a pooled, cached handle to bucket_name
+        (defaults to the BUCKET env var) '''
+    if bucket_name is None:
+        bucket_name = os.environ['BUCKET']
+    return get_s3_pool().bucket(bucket_name)
+
+
+def s3_pool_stats():
+    ''' returns the hit/miss counters of the s3 connection pool '''
+    return get_s3_pool().stats()
+
+
+def get_listing_cache():
+    ''' returns the process wide listing cache, configured from the
+        LISTING_CACHE_* env vars on first use '''
+    global _listing_cache
+    if _listing_cache is None:
+        with _listing_cache_lock:
+            if _listing_cache is None:
+                _listing_cache = cache_from_env()
+    return _listing_cache
+
+
+def listing_cache_stats():
+    ''' returns the hit/miss counters of the listing cache '''
+    return get_listing_cache().stats()
+
+
+def download_url_lifetime():
+    ''' seconds a presigned download url is valid for '''
+    return int(os.environ.get('DOWNLOAD_URL_LIFETIME', 3600))
+
+
+def get_url_cache():
+    ''' returns the process wide cache of presigned download urls. urls
+        are signed for DOWNLOAD_URL_LIFETIME seconds (default 3600) and
+        handed out again until fewer than DOWNLOAD_URL_MIN_REMAINING
+        (default 1800) are left '''
+    global _url_cache
+    if _url_cache is None:
+        with _url_cache_lock:
+            if _url_cache is None:
+                lifetime = download_url_lifetime()
+                remaining = int(os.environ.get('DOWNLOAD_URL_MIN_REMAINING',
+                                               1800))
+                _url_cache = ListingCache(
+                    ttl=max(0, lifetime - remaining),
+                    max_entries=int(os.environ.get(
+                        'DOWNLOAD_URL_CACHE_ENTRIES', 10000)),
+                    max_bytes=16 * 1024 * 1024)
+    return _url_cache
+
+
+def url_cache_stats():
+    ''' returns the hit/miss counters of the download url cache '''
+    return get_url_cache().stats()
+
+
+def flight_stats():
+    ''' returns the counters of the shared in-flight s3 calls '''
+    return _flights.stats()
+
+
+def invalidate_listings(prefix):
+    ''' drops cached listings that may include keys under prefix; call
+        after writing to the bucket '''
+    get_listing_cache().invalidate(prefix)
+    index = get_object_index()
+    if index is not None:
+        index.mark_stale(prefix)
+
+
+def get_object_index(refresh=True):
+    ''' returns the local object index configured by the OBJECT_INDEX_*
+        env vars, or None when OBJECT_INDEX_PATH is not set. unless
+        refresh is False, a background thread keeps it in sync every
+        OBJECT_INDEX_INTERVAL seconds '''
+    global _object_index
+    path = os.environ.get('OBJECT_INDEX_PATH')
+    if not path:
+        return None
+    if _object_index is None:
+        with _object_index_lock:
+            if _object_index is None:
+                index = ObjectIndex(path, s3_bucket,
+                                    prefix=os.environ.get('OBJECT_INDEX_PREFIX',
+                                                          'uploads/'))
+                interval = float(os.environ.get('OBJECT_INDEX_INTERVAL', 60))
+                if refresh and interval > 0:
+                    index.start_refresher(interval,
+                                          os.environ.get('OBJECT_INDEX_EVENTS'))
+                _object_index = index
+    return _object_index
+
+
+def _listing_record(f):
+    ''' converts a boto listing result to a cacheable record; returns
+        None for delete markers '''
+    if type(f) is boto.s3.key.Key:
+        return S3Version(f.name, f.version_id, f.last_modified, int(f.size))
+    if type(f) is Prefix:
+        return S3Folder(f.name)
+    return None
+
+
+def _versions_key(prefix, delimiter):
+    return 'versions|%s|%s|%s' % (os.environ['BUCKET'], delimiter, prefix)
+
+
+def cached_versions(prefix, delimiter=''):
+    ''' the records of iter_s3_versions(prefix, delimiter) if they are in
+        the listing cache, else None. never lists s3 '''
+    return get_listing_cache().get(_versions_key(prefix, delimiter))
+
+
+@timed('list_versions')
+def iter_s3_versions(prefix, delimiter=''):
+    ''' yields the S3Version records under prefix, plus S3Folder records
+        when listing with a delimiter. served from the listing cache when
+        possible; otherwise records are yielded as pages arrive from s3
+        and the complete listing is cached afterwards. prefixes covered by
+        the object index are answered by it without touching s3.
+
+        concurrent requests for the same uncached listing share it: the
+        first one lists s3, streaming as usual, and the others wait for
+        its complete result '''
+    index = get_object_index()
+    if index is not None and index.covers(prefix):
+        for r in index.iter_versions(prefix, delimiter):
+            yield r
+        return
+
+    cache = get_listing_cache()
+    ckey = _versions_key(prefix, delimiter)
+    while True:
+        records = cache.get(ckey)
+        if records is None:
+            call, leader = _flights.begin(ckey)
+            if leader:
+                break
+            records = call.result()
+        if records is not None:
+            for r in records:
+                yield r
+            return
+        # the listing was abandoned midway; one of the waiters redoes it
+
+    records = []
+    try:
+        for r in _iter_listing(prefix, delimiter, records):
+            yield r
+    except GeneratorExit:
+        _flights.finish(ckey, call)
+        raise
+    except:
+        _flights.finish(ckey, call, error=sys.exc_info())
+        raise
+    _flights.finish(ckey, call, records)
+    try:
+        cache.set(ckey, prefix, records)
+    except:
+        logging.error('caching the listing of %s failed: %s'
+                      % (prefix, str(sys.exc_info())))
+
+
+def _iter_listing(prefix, delimiter, records):
+    ''' lists prefix from s3, yielding the records as they arrive and
+        appending them to records '''
+    if delimiter:
+        with s3_bucket() as bucket:
+            for f in bucket.list_versions(prefix=prefix, delimiter=delimiter):
+                r = _listing_record(f)
+                if r is not None:
+                    records.append(r)
+                    yield r
+        return
+    for f in iter_s3_listing(prefix):
+        r = _listing_record(f)
+        if r is not None:
+            records.append(r)
+            yield r
+
+
+def iter_s3_listing(prefix):
+    ''' yields the boto versions and delete markers under prefix straight
+        from s3, in listing order. prefixes holding several folders are
+        split into ranges of folders, listed on LISTING_WORKERS threads
+        at once '''
+    shards = _listing_shards(prefix, listing_workers())
+    if len(shards) == 1:
+        with s3_bucket() as bucket:
+            for f in bucket.list_versions(prefix=prefix):
+                yield f
+        return
+    pool = ThreadPool(min(listing_workers(), len(shards)))
+    try:
+        # imap hands back the shards in key order, as each completes
+        list_range = bind_request(lambda s: _list_range(prefix, *s))
+        for shard in pool.imap(list_range, shards):
+            for f in shard:
+                yield f
+    finally:
+        pool.terminate()
+
+
+def listing_workers():
+    ''' number of threads a listing is split across (LISTING_WORKERS,
+        default 4), at most the size of the connection pool '''
+    workers = int(os.environ.get('LISTING_WORKERS', 4))
+    return max(1, min(workers, get_s3_pool().size))
+
+
+def _listing_shards(prefix, workers):
+    ''' splits the keys under prefix into up to 2 * workers contiguous
+        ranges of whole folders, found with a delimiter LIST (itself
+        cached). returns a list of (start, end) bounds; None for open '''
+    if workers <= 1:
+        return [(None, None)]
+    folders = [r.name for r in iter_s3_versions(prefix, delimiter='/')
+               if type(r) is S3Folder]
+    count = min(len(folders), 2 * workers)
+    if count <= 1:
+        return [(None, None)]
+    starts = [folders[len(folders) * i // count] for i in range(1, count)]
+    return zip([None] + starts, starts + [None])
+
+
+def _list_range(prefix, start, end):
+    ''' the versions and delete markers under prefix with start <= key <
+        end. start is a folder prefix: the folder is listed by its own
+        prefix, and the rest of the range after its last key, so sibling
+        folders sorting just below it (acme-eu/, acme.old/) aren't walked
+        by every shard '''
+    entries = []
+    marker = ''
+    with s3_bucket() as bucket:
+        if start is not None:
+            marker = start
+            for f in bucket.list_versions(prefix=start):
+                entries.append(f)
+                marker = f.name
+        for f in bucket.list_versions(prefix=prefix, key_marker=marker):
+            if end is not None and f.name >= end:
+                break
+            entries.append(f)
+    return entries
+
+
 # deprecated; cant use temp creds otherwise signatures are temp
 def get_temp_creds():
     ''' returns current set of temp iam role creds '''
@@ -113,130 +488,221 @@ def get_user(request):
         return 'error'
 
 
-def get_s3_files(prefix):
-    ''' lists files froms s3 instead of local disk
-        returns tuple of (name, verion_id, last modified, size in K)
-    '''
-    bucket_name = os.environ['BUCKET']
+# iso 8601 timestamps sort like the dates they stand for, so rows are
+# sorted without parsing them
+TABLE_SORT_KEYS = {'key': lambda r: (r.key, r.last_modified),
+                   'dir': lambda r: (r.dir, r.name),
+                   'name': lambda r: (r.name, r.dir),
+                   'date': lambda r: r.last_modified,
+                   'size': lambda r: r.bytes}
 
-    try:
-        ak, sk = get_env_creds()
-        s3 = boto.connect_s3(aws_access_key_id=ak,
-                             aws_secret_access_key=sk)
-        bucket = s3.get_bucket(bucket_name)
-    except:
-        logging.error('get_s3_files: Could not connect to AWS/Bucket: %s'
-                      % str(sys.exc_info()))
-    files = bucket.list_versions(prefix=prefix)
-    filelist = []
-    for f in files:
-        if type(f) is not boto.s3.key.Key:
-            continue
-        size_in_mb = '%.2f' % (float(f.size) / (1024*1024))  # as a string
-        dfmt = '%Y-%m-%dT%H:%M:%S.000Z'
-        date = datetime.strptime(f.last_modified, dfmt)
-        filelist.append((f.name, f.version_id, date, size_in_mb))
-    return filelist
 
+def encode_marker(key_marker, version_id_marker):
+    ''' packs s3 list_versions markers into an opaque, url safe token '''
+    return base64.urlsafe_b64encode(json.dumps([key_marker,
+                                                version_id_marker]))
 
-def get_s3_files_table(prefix):
-    ''' list files from s3, to be used with table listing; return dicts '''
-    bucket_name = os.environ['BUCKET']
 
+def decode_marker(token):
+    ''' inverse of encode_marker; raises ValueError on a bad token '''
     try:
-        ak, sk = get_env_creds()
-        s3 = boto.connect_s3(aws_access_key_id=ak,
-                             aws_secret_access_key=sk)
-        bucket = s3.get_bucket(bucket_name)
+        key_marker, version_id_marker = json.loads(
+            base64.urlsafe_b64decode(str(token)))
     except:
-        logging.error('get_s3_files: Could not connect to AWS/Bucket: %s'
-                      % str(sys.exc_info()))
-    files = bucket.list_versions(prefix=prefix)
-    filelist = []
-    for f in files:
-        if type(f) is not boto.s3.key.Key:
+        raise ValueError('Invalid continuation token')
+    return key_marker, version_id_marker
+
+
+def _etag(*parts):
+    ''' an etag of parts and the templates the pages are rendered with '''
+    return hashlib.md5(repr((tree_version('templates'),) + parts)).hexdigest()
+
+
+def index_etag(prefix, *parts):
+    ''' etag of a listing of prefix answered by the object index, taken
+        from the index generation without running the query; None when
+        the index doesn't cover prefix. parts are whatever else the
+        response depends on, eg its query string '''
+    index = get_object_index()
+    if index is None or not index.covers(prefix):
+        return None
+    return _etag('index', index.generation, prefix, *parts)
+
+
+def listing_etag(records, *parts):
+    ''' returns (etag, last_modified) of a listing: the etag changes when
+        a version or folder is added to or removed from records, or when
+        any of parts does. last_modified is the time of the newest
+        version, as a datetime; None if there is none '''
+    md5 = hashlib.md5(_etag(*parts))
+    newest = ''
+    for r in records:
+        if type(r) is S3Folder:
+            md5.update('%s\0' % r.name.encode('utf-8'))
             continue
-        size_in_mb = '%.2f' % (float(f.size) / (1024*1024))
-        key = f.name[len(prefix):]
-        directory = key.partition('/')[0]
-        filename = key.partition('/')[-1]
-        cb64 = urllib2.quote((f.name).encode('base64').rstrip())
-        vb64 = urllib2.quote(f.version_id.encode('base64').rstrip())
-        dfmt = '%Y-%m-%dT%H:%M:%S.000Z'
-        date = datetime.strptime(f.last_modified, dfmt)
-        d = { 'name' : filename,
-              'dir'  : directory,
-              'v_id' : f.version_id,
-              'date' : date,
-              'size' : size_in_mb,
-              'cb64' : cb64,
-              'vb64' : vb64,
-              'key'  : key}
-        filelist.append(d)
-    return filelist
-
-
-def ztree_files(prefix):
-    ''' Takes in a list of s3 keys and generates a JSON doc
-        to be used by ztree, for pretty print listing '''
-    s3files = get_s3_files(prefix)
-    filesd = {}
-    # generate the dictionary
-    for f in s3files:
-        key = f[0][len(prefix):]  # ignore this universal prefix
-        version_id = f[1]
-        last_modified = f[2]
-        size = f[3]
-        directory = key.partition('/')[0]
-        filename = key.partition('/')[-1]
-        filetuple = (filename, version_id, last_modified, size)
-        if directory not in filesd:
-            filesd[directory] = []
-            filesd[directory].append(filetuple)
-            continue
-        if directory in filesd:
-            filesd[directory].append(filetuple)
-
-    outd = []
-    # create a dict of array of children nodes
-    for key in filesd.keys():
-        childdict = []
-        for child in filesd[key]:
-            name = child[0]
-            version_id = child[1]
-            last_modified = child[2]
-            size = child[3]
-            filestring = '[%s] %s - %s MiB' % (last_modified, name, size)  # the displayed text
-            cb64 = urllib2.quote((prefix + key + '/' + name).encode('base64').rstrip())  # used for download link only
-            vb64 = urllib2.quote(version_id.encode('base64').rstrip())
-            childdict.append({'name': filestring,
-                              'url': '/gendl?keyname=' + cb64 + '&version=' + vb64})
-        outd.append({'name': key,
-                     'children': childdict,
-                     'url': '/files?folder=' + key + '&view=tree'})
-
-    return json.dumps(outd)
-
-
-def get_temp_s3_url(keyname, version_id):
-    ''' generates a temporary download url for keyname; limited lifetime '''
-    bucket_name = os.environ['BUCKET']
-
-    try:
-        ak, sk = get_env_creds()
-        s3 = boto.connect_s3(aws_access_key_id=ak,
-                             aws_secret_access_key=sk)
-        bucket = s3.get_bucket(bucket_name)
-    except:
-        logging.error('temp_s3_url: Could not connect to AWS/Bucket: %s'
-                      % str(sys.exc_info()))
+        md5.update('%s\0%s\0' % (r.name.encode('utf-8'), r.version_id))
+        newest = max(newest, r.last_modified)
+    return md5.hexdigest(), newest and parse_timestamp(newest) or None
+
+
+@timed('files_page')
+def get_s3_files_page(prefix, page_size=500, marker=None,
+                      sort='key', reverse=False):
+    ''' one page of the table listing; costs at most one LIST request,
+        none when the page is cached or the object index covers prefix.
+        returns (rows, next_marker). next_marker is None on the last page.
+
+        s3 returns versions in key order, which is the order pages are
+        walked in; any other sort key orders the rows within the page '''
+    if sort not in TABLE_SORT_KEYS:
+        raise ValueError('Invalid sort key: %s' % sort)
+    page_size = max(1, min(int(page_size), 1000))
+    key_marker, version_id_marker = None, None
+    if marker:
+        key_marker, version_id_marker = decode_marker(marker)
+
+    cache = get_listing_cache()
+    ckey = 'page|%s|%s|%s|%s|%d' % (os.environ['BUCKET'], prefix,
+                                    key_marker, version_id_marker, page_size)
+    index = get_object_index()
+    if index is not None and index.covers(prefix):
+        records, next_markers = index.page(prefix, page_size,
+                                           key_marker, version_id_marker)
+        page = (records, next_markers and encode_marker(*next_markers))
+    else:
+        page = cache.get(ckey)
+    if page is None:
+        page = _flights.do(ckey, _fetch_page, ckey, prefix, key_marker,
+                           version_id_marker, page_size)
+
+    records, next_marker = page
+    rows = [FileRow(f, prefix) for f in records]
+    if sort != 'key' or reverse:
+        rows.sort(key=TABLE_SORT_KEYS[sort], reverse=reverse)
+    return rows, next_marker
+
+
+def _fetch_page(ckey, prefix, key_marker, version_id_marker, page_size):
+    ''' one page of versions from s3, as (records, next_marker); cached '''
+    with s3_bucket() as bucket:
+        rs = bucket.get_all_versions(prefix=prefix,
+                                     key_marker=key_marker,
+                                     version_id_marker=version_id_marker,
+                                     max_keys=page_size)
+    records = [r for r in map(_listing_record, rs) if r is not None]
+    next_marker = None
+    if rs.is_truncated:
+        next_marker = encode_marker(rs.next_key_marker,
+                                    rs.next_version_id_marker)
+    page = (records, next_marker)
+    get_listing_cache().set(ckey, prefix, page)
+    return page
+
+
+@timed('ztree_nodes')
+def iter_ztree_nodes(prefix, path='', records=None):
+    ''' one level of the file tree, for ztree's async mode. lists
+        prefix + path with a '/' delimiter, so only the folders and file
+        versions directly below it are returned; folders are expanded on
+        demand by asking again with path set to the folder node's id.
+        nodes are yielded as listing pages arrive from s3, or built from
+        records when that listing was already fetched '''
+    if records is None:
+        records = iter_s3_versions(prefix + path, delimiter='/')
+    for f in records:
+        relpath = f.name[len(prefix):]  # ignore this universal prefix
+        name = relpath.rstrip('/').rpartition('/')[-1]
+        if type(f) is S3Folder:
+            yield {'name': name,
+                   'id': relpath,
+                   'isParent': True,
+                   'url': '/files?folder=' + relpath.rstrip('/') +
+                          '&view=tree'}
+        else:
+            filestring = '[%s] %s - %s MiB' % (
+                parse_timestamp(f.last_modified), name, format_size(f.size))
+            yield {'name': filestring,
+                   'url': '/gendl?keyname=' + url_token(f.name) +
+                          '&version=' + url_token(f.version_id)}
+
+
+def iter_json_array(items):
+    ''' encodes the iterable items as a single JSON array, yielding it
+        piece by piece so a response can be streamed while items are
+        still being produced '''
+    yield '['
+    sep = ''
+    for item in items:
+        yield sep + json.dumps(item)
+        sep = ','
+    yield ']'
+
+
+@timed('authorize_key')
+def get_authorized_key(keyname, version_id, prefix):
+    ''' returns the s3 key for keyname/version_id if it exists and lives
+        under prefix, None otherwise. answered by the object index when it
+        knows the version, otherwise costs a single HEAD request; either
+        way, no matter how many objects are in the bucket '''
+    if not keyname.startswith(prefix) or keyname == prefix:
+        return None
+    index = get_object_index()
+    if index is not None and index.exists(keyname, version_id):
+        with s3_bucket() as bucket:
+            key = boto.s3.key.Key(bucket, keyname)
+            key.version_id = version_id
+            return key
     try:
-        key = bucket.get_key(key_name=keyname, version_id=version_id)
-        return key.generate_url(expires_in=3600)
-    except:
-        logging.error('Could not generate temp url: %s'
-                      % str(sys.exc_info()))
-        return 'Error'
+        return head_key(keyname, version_id)
+    except S3ResponseError:
+        # a malformed version id is a 400, not a missing key
+        return None
+
+
+def _head_key(keyname, version_id):
+    with s3_bucket() as bucket:
+        return bucket.get_key(key_name=keyname, version_id=version_id)
+
+
+def head_key(keyname, version_id):
+    ''' the s3 key of keyname/version_id (a HEAD request), None if it
+        doesn't exist. concurrent lookups of the same version share one
+        request '''
+    return _flights.do('head|%s|%s|%s' % (os.environ['BUCKET'], keyname,
+                                          version_id),
+                       _head_key, keyname, version_id)
+
+
+@timed('download_url')
+def get_download_url(keyname, version_id, prefix):
+    ''' returns (url, expires) for downloading keyname/version_id, or None
+        if it doesn't exist or lives outside prefix. expires is when the
+        url stops working, as a utc datetime. a url handed out recently
+        is reused, with neither a HEAD request nor signing; otherwise the
+        key is checked (see get_authorized_key) and a url signed locally '''
+    if not keyname.startswith(prefix) or keyname == prefix:
+        return None
+    cache = get_url_cache()
+    ckey = '%s|%s|%s' % (os.environ['BUCKET'], keyname, version_id)
+    cached = cache.get(ckey)
+    if cached is not None:
+        return cached
+    return _flights.do('url|' + ckey, _sign_download_url, ckey, keyname,
+                       version_id, prefix)
+
+
+def _sign_download_url(ckey, keyname, version_id, prefix):
+    ''' checks and signs a download url, see get_download_url '''
+    if get_authorized_key(keyname, version_id, prefix) is None:
+        return None
+    cache = get_url_cache()
+    lifetime = download_url_lifetime()
+    access_key, secret_key = get_env_creds()
+    url = presign_s3_url('GET', os.environ['BUCKET'], keyname, access_key,
+                         secret_key, lifetime, {'versionId': version_id})
+    expires = datetime.utcnow() + timedelta(seconds=lifetime)
+    cache.set(ckey, keyname, (url, expires))
+    return url, expires
 
 
 def valid_name(s):
@@ -279,70 +745,131 @@ def sign_policy(policy, secret):
     return signature, policy
 
 
+def verify_policy(policy, signature, secret):
+    ''' checks a b64 policy and signature made by sign_policy and returns
+        the decoded policy document; raises ValueError if the signature
+        doesn't match or the policy has expired '''
+    expected = sign_policy(base64.b64decode(str(policy)), secret)[0]
+    if not hmac.compare_digest(expected, str(signature)):
+        raise ValueError('Invalid policy signature')
+    document = json.loads(base64.b64decode(str(policy)))
+    expiration = datetime.strptime(document['expiration'],
+                                   '%Y-%m-%dT%H:%M:%SZ')
+    if expiration < datetime.utcnow():
+        raise ValueError('This upload link has expired')
+    return document
+
+
+def presign_s3_url(method, bucket_name, keyname, access_key, secret,
+                   expires_in, subresources=None):
+    ''' returns a query string authenticated (signature v2) url for
+        method on keyname, valid for expires_in seconds. signed locally,
+        no request is made to s3. subresources, eg partNumber/uploadId
+        or versionId, are signed and added to the query string '''
+    subresources = sorted((subresources or {}).items())
+    expires = int(time.time() + expires_in)
+    path = '/' + urllib.quote(keyname.encode('utf-8'), safe='/~')
+    resource = '/' + bucket_name + path
+    if subresources:
+        resource += '?' + '&'.join('%s=%s' % kv for kv in subresources)
+    string_to_sign = '%s\n\n\n%d\n%s' % (method, expires, resource)
+    signature = base64.b64encode(hmac.new(secret, string_to_sign,
+                                          hashlib.sha1).digest())
+    query = subresources + [('AWSAccessKeyId', access_key),
+                            ('Expires', expires),
+                            ('Signature', signature)]
+    return 'https://%s.s3.amazonaws.com%s?%s' % (bucket_name, path,
+                                                 urllib.urlencode(query))
+
+
+@timed('upload_form')
 def upload_s3(contents,
               bucket_name):
     ''' Upload a file to the s3 bucket, set permissions to everyone read
         return url '''
 
     try:
-        ak, sk = get_env_creds()
-        s3 = boto.connect_s3(aws_access_key_id=ak,
-                             aws_secret_access_key=sk)
-        bucket = s3.get_bucket(bucket_name)
+        with s3_bucket(bucket_name) as bucket:
+            k = boto.s3.key.Key(bucket)
+            filename = str(uuid.uuid4()) + '.html'
+            k.key = 'upload_forms/' + filename
+            k.content_type = 'html'
+            k.set_contents_from_string(contents)
+            k.make_public()
+            return k.generate_url(expires_in=60 * 60 * 24 * 30)
     except:
-        print 'Could not connect to AWS/Bucket: %s' % str(sys.exc_info())
-
-    try:
+        print 'Error uploading html form to s3: %s' % str(sys.exc_info())
+
+
+def get_lifecycle_manager(bucket_name):
+    ''' returns the process wide lifecycle rule manager of bucket_name,
+        configured from the LIFECYCLE_* env vars '''
+    with _lifecycle_managers_lock:
+        if bucket_name not in _lifecycle_managers:
+            _lifecycle_managers[bucket_name] = LifecycleManager(
+                lambda: s3_bucket(bucket_name),
+                ttl=float(os.environ.get('LIFECYCLE_CACHE_TTL', 30)),
+                delay=float(os.environ.get('LIFECYCLE_COALESCE_DELAY', 0)))
+        return _lifecycle_managers[bucket_name]
+
+
+def _write_lifecycle_placeholder(bucket, directory, expiration):
+    ''' if there are no files in this folder yet, create a placeholder
+        lifecycle file '''
+    # two keys are enough to tell; a single capped LIST, however many files
+    # the folder holds. slash-terminated, so 'acme' doesn't see 'acme2'
+    files = bucket.get_all_keys(prefix=directory.rstrip('/') + '/',
+                                max_keys=2)
+    if len(files) <= 1:  # insert a dummy file; needed elsewise the policy won't apply
         k = boto.s3.key.Key(bucket)
-        filename = str(uuid.uuid4()) + '.html'
-        k.key = 'upload_forms/' + filename
-        k.content_type = 'html'
-        k.set_contents_from_string(contents)
-        k.make_public()
-        return k.generate_url(expires_in=60 * 60 * 24 * 30)
+        k.key = directory + '/.lifecycle_policy.txt'
+        utc_now = datetime.utcnow()
+        exp_time = utc_now + timedelta(days=expiration)
+        content = ('This file was created by the upload portal. The '
+                   'expiration policy for this folder was created on %s.'
+                   ' These file(s) will automatically expire %s days'
+                   ' later, on %s.') % (utc_now.ctime(),
+                                        str(expiration),
+                                        exp_time.ctime())
+        k.set_contents_from_string(content)
+        invalidate_listings(directory)
+
+
+@timed('create_folders')
+def create_folders_and_lifecycle(bucket_name, rules, workers=8):
+    ''' creates or modifies the folders of rules, a list of (directory,
+        expiration days) tuples, and merges all of their expiration
+        lifecycle rules into the bucket's configuration with a single
+        write. returns an error string on failure '''
+    rules = list(rules)
+    if not rules:
+        return
+
+    def placeholder(rule):
+        try:
+            with s3_bucket(bucket_name) as bucket:
+                _write_lifecycle_placeholder(bucket, *rule)
+        except:
+            pass
+
+    if len(rules) == 1:
+        placeholder(rules[0])
+    else:
+        pool = ThreadPool(min(workers, len(rules)))
+        try:
+            pool.map(bind_request(placeholder), rules)
+        finally:
+            pool.close()
+
+    # Merge the folders' rules into the bucket's life cycle configuration
+    try:
+        get_lifecycle_manager(bucket_name).set_expirations(rules)
     except:
-        print 'Error uploading html form to s3'
+        return 'Error creating lifecycle: %s' % str(sys.exc_info())
 
 
 def create_folder_and_lifecycle(bucket_name, directory, expiration):
     ''' creates or modifies an existing folder and modifies
         the expiration lifecyce '''
-    # Connect to s3 and get the bucket object
-    try:
-        ak, sk = get_env_creds()
-        s3 = boto.connect_s3(aws_access_key_id=ak,
-                             aws_secret_access_key=sk)
-        bucket = s3.get_bucket(bucket_name)
-    except:
-        print 'Could not connect to AWS/Bucket: %s' % str(sys.exc_info())
-    # if there are no files in this folder yet, create a placeholder lifecycle file
-    try:
-        count = 0
-        files = bucket.list(prefix=directory)
-        for f in files:
-            count += 1
-        if count <= 1:  # insert a dummy file; needed elsewise the policy won't apply
-            k = boto.s3.key.Key(bucket)
-            k.key = directory + '/.lifecycle_policy.txt'
-            utc_now = datetime.utcnow()
-            exp_time = utc_now + timedelta(days=expiration)
-            content = ('This file was created by the upload portal. The '
-                       'expiration policy for this folder was created on %s.'
-                       ' These file(s) will automatically expire %s days'
-                       ' later, on %s.') % (utc_now.ctime(),
-                                            str(expiration),
-                                            exp_time.ctime())
-            k.set_contents_from_string(content)
-    except:
-        pass
-    # Create and apply the life cycle object to the prefix
-    try:
-        directory = directory.encode('ascii')
-        lifecycle = Lifecycle()
-        lifecycle.add_rule(id=directory,
-                           prefix=directory,
-                           status='Enabled',
-                           expiration=expiration)
-        bucket.configure_lifecycle(lifecycle)
-    except:
-        return 'Error creating lifecycle: %s' % str(sys.exc_info())
+    return create_folders_and_lifecycle(bucket_name,
+                                        [(directory, expiration)])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import zlib
+import struct
+from collections import namedtuple
+
+# one file of the archive; mtime is a datetime, size in bytes
+ZipMember = namedtuple('ZipMember', 'name size mtime')
+
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP16_LIMIT = 0xFFFF
+VERSION = 20        # version needed to extract a plain stored member
+VERSION_ZIP64 = 45
+FLAGS = 0x08 | 0x800  # sizes/crc in a data descriptor; utf-8 names
+
+
+def _dos_time(dt):
+    if dt.year < 1980:
+        return 0, (1 << 5) | 1  # 1980-01-01
+    return ((dt.hour << 11) | (dt.minute << 5) | (dt.second // 2),
+            ((dt.year - 1980) << 9) | (dt.month << 5) | dt.day)
+
+
+class ZipStream(object):
+    ''' a store-only (uncompressed) zip archive of members, produced as a
+        stream of byte strings while the member data is being read, so
+        the archive is never held in memory. crcs are computed on the fly
+        and written in data descriptors after each member; ZIP64 records
+        are used for members, offsets and counts past the classic limits.
+
+        since nothing is compressed, the archive length is known up front
+        (see length), which lets clients show download progress '''
+
+    def __init__(self, members):
+        self.members = list(members)
+        self._names = [m.name.encode('utf-8') if isinstance(m.name, unicode)
+                       else m.name for m in self.members]
+
+    def _zip64(self, member):
+        return member.size >= ZIP64_LIMIT
+
+    def _local_header(self, member, name):
+        time, date = _dos_time(member.mtime)
+        if self._zip64(member):
+            extra = struct.pack('<HHQQ', 1, 16, 0, 0)
+            version, size = VERSION_ZIP64, ZIP64_LIMIT
+        else:
+            extra, version, size = '', VERSION, 0
+        return struct.pack('<IHHHHHIIIHH', 0x04034b50, version, FLAGS, 0,
+                           time, date, 0, size, size, len(name),
+                           len(extra)) + name + extra
+
+    def _descriptor(self, member, crc):
+        if self._zip64(member):
+            return struct.pack('<IIQQ', 0x08074b50, crc, member.size,
+                               member.size)
+        return struct.pack('<IIII', 0x08074b50, crc, member.size,
+                           member.size)
+
+    def _central_header(self, member, name, crc, offset):
+        time, date = _dos_time(member.mtime)
+        extra = ''
+        size = member.size
+        if size >= ZIP64_LIMIT:
+            extra += struct.pack('<QQ', size, size)
+            size = ZIP64_LIMIT
+        if offset >= ZIP64_LIMIT:
+            extra += struct.pack('<Q', offset)
+            offset = ZIP64_LIMIT
+        if extra:
+            extra = struct.pack('<HH', 1, len(extra)) + extra
+        version = VERSION_ZIP64 if extra else VERSION
+        return struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, version,
+                           version, FLAGS, 0, time, date, crc, size, size,
+                           len(name), len(extra), 0, 0, 0, 0o100644 << 16,
+                           offset) + name + extra
+
+    def _end(self, count, cd_offset, cd_size):
+        end = ''
+        if (count >= ZIP16_LIMIT or cd_offset >= ZIP64_LIMIT or
+                cd_size >= ZIP64_LIMIT):
+            end += struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, VERSION_ZIP64,
+                               VERSION_ZIP64, 0, 0, count, count, cd_size,
+                               cd_offset)
+            end += struct.pack('<IIQI', 0x07064b50, 0, cd_offset + cd_size,
+                               1)
+        return end + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0,
+                                 min(count, ZIP16_LIMIT),
+                                 min(count, ZIP16_LIMIT),
+                                 min(cd_size, ZIP64_LIMIT),
+                                 min(cd_offset, ZIP64_LIMIT), 0)
+
+    def length(self):
+        ''' size in bytes of the whole archive '''
+        offset = 0
+        cd_size = 0
+        for member, name in zip(self.members, self._names):
+            offset_before = offset
+            offset += (len(self._local_header(member, name)) + member.size +
+                       len(self._descriptor(member, 0)))
+            cd_size += len(self._central_header(member, name, 0,
+                                                offset_before))
+        return offset + cd_size + len(self._end(len(self.members), offset,
+                                                cd_size))
+
+    def stream(self, chunks):
+        ''' yields the archive. chunks is an iterator over the data of the
+            members, in order; a chunk never spans two members. raises
+            IOError if the data doesn't add up to the member sizes '''
+        offset = 0
+        central = []
+        for member, name in zip(self.members, self._names):
+            header = self._local_header(member, name)
+            yield header
+            crc = 0
+            remaining = member.size
+            while remaining > 0:
+                try:
+                    data = next(chunks)
+                except StopIteration:
+                    data = ''
+                if not data or len(data) > remaining:
+                    raise IOError('Unexpected data length for %s'
+                                  % member.name)
+                crc = zlib.crc32(data, crc)
+                remaining -= len(data)
+                yield data
+            crc &= 0xFFFFFFFF
+            descriptor = self._descriptor(member, crc)
+            yield descriptor
+            central.append(self._central_header(member, name, crc, offset))
+            offset += len(header) + member.size + len(descriptor)
+
+        cd = ''.join(central)
+        yield cd
+        yield self._end(len(self.members), offset, len(cd))
@@ -0,0 +1,17 @@
+#!/usr/bin/env python
+''' the multipart upload endpoints (/mpu/*) of the app, and nothing else.
+    the app has no authentication, so this is what to expose to
+    customers' browsers when portals use multipart uploads; serve the
+    full application on a private address for staff:
+
+        gunicorn -c gunicorn.conf.py -b 0.0.0.0:8443 portal_api:application
+'''
+
+from werkzeug.exceptions import NotFound
+from application import app
+
+
+def application(environ, start_response):
+    if not environ.get('PATH_INFO', '').startswith('/mpu/'):
+        return NotFound()(environ, start_response)
+    return app(environ, start_response)
@@ -0,0 +1,258 @@
+/*
+ * Multipart uploads for the customer portals.
+ *
+ * The file is cut into parts which are PUT straight to S3, several at a
+ * time, through presigned urls handed out by the portal application.
+ * Every call to the application carries the portal's signed policy.
+ *
+ * Uploads are resumable: the upload id of each file (keyed by its name,
+ * size and modification time) and its finished parts are kept in
+ * localStorage. Adding the same file again after a failure or a page
+ * reload asks the application which parts S3 already has and only sends
+ * the missing ones.
+ */
+var S3Multipart = (function($) {
+
+  var MIN_PART_SIZE = 8 * 1024 * 1024;
+  var MAX_PARTS = 10000;
+
+  function S3Multipart(options) {
+    this.api = options.api.replace(/\/$/, "");
+    this.policy = options.policy;
+    this.signature = options.signature;
+    this.concurrency = options.concurrency || 4;
+    this.retries = options.retries || 5;
+  }
+
+  S3Multipart.partSize = function(size) {
+    var mb = 1024 * 1024;
+    return Math.max(MIN_PART_SIZE, Math.ceil(size / MAX_PARTS / mb) * mb);
+  };
+
+  // saved upload state, or null when storage is unavailable (private mode)
+  function storage() {
+    try {
+      return window.localStorage || null;
+    } catch (e) {
+      return null;
+    }
+  }
+
+  S3Multipart.prototype.storageKey = function(file) {
+    var modified = file.lastModified || (file.lastModifiedDate && +file.lastModifiedDate) || 0;
+    return ["s3mpu", this.signature, file.name, file.size, modified].join(":");
+  };
+
+  S3Multipart.prototype.load = function(file) {
+    var store = storage();
+    try {
+      return store && $.parseJSON(store.getItem(this.storageKey(file)));
+    } catch (e) {
+      return null;
+    }
+  };
+
+  S3Multipart.prototype.save = function(file, upload) {
+    var store = storage();
+    try {
+      store && store.setItem(this.storageKey(file), JSON.stringify(upload));
+    } catch (e) {
+      // quota exceeded; the upload just won't be resumable
+    }
+  };
+
+  S3Multipart.prototype.forget = function(file) {
+    var store = storage();
+    store && store.removeItem(this.storageKey(file));
+  };
+
+  S3Multipart.prototype.call = function(action, data) {
+    return $.ajax({
+      type: "POST",
+      url: this.api + "/mpu/" + action,
+      dataType: "json",
+      data: $.extend({policy: this.policy, signature: this.signature}, data)
+    });
+  };
+
+  // PUT one part, re-signing and retrying with backoff on failure
+  S3Multipart.prototype.putPart = function(upload, number, offset, blob, total, progress) {
+    var self = this;
+    var deferred = $.Deferred();
+    var attempt = 0;
+
+    function tryPut() {
+      attempt++;
+      self.call("sign", {key: upload.key, upload_id: upload.upload_id, part: number,
+                         offset: offset, size: blob.size, total: total})
+        .done(function(signed) {
+          var xhr = new XMLHttpRequest();
+          xhr.open("PUT", signed.url, true);
+          xhr.upload.onprogress = function(e) { progress(e.loaded); };
+          xhr.onload = function() {
+            if (xhr.status == 200) {
+              progress(blob.size);
+              deferred.resolve();
+            } else {
+              retry();
+            }
+          };
+          xhr.onerror = retry;
+          xhr.send(blob);
+        })
+        .fail(retry);
+    }
+
+    function retry() {
+      progress(0);
+      if (attempt > self.retries) {
+        deferred.reject("Part " + number + " failed after " + attempt + " attempts");
+      } else {
+        setTimeout(tryPut, 1000 * Math.pow(2, attempt));
+      }
+    }
+
+    tryPut();
+    return deferred.promise();
+  };
+
+  // upload the parts in `numbers` of `file`, `concurrency` at a time
+  S3Multipart.prototype.putParts = function(upload, file, numbers, callbacks) {
+    var self = this;
+    var deferred = $.Deferred();
+    var partSize = upload.partSize;
+    var queue = numbers.slice();
+    var running = 0;
+    var failed = false;
+
+    function next() {
+      if (failed) {
+        return;
+      }
+      if (!queue.length && !running) {
+        deferred.resolve();
+        return;
+      }
+      while (running < self.concurrency && queue.length) {
+        (function(number) {
+          var start = (number - 1) * partSize;
+          var blob = file.slice(start, Math.min(start + partSize, file.size));
+          running++;
+          self.putPart(upload, number, start, blob, file.size, function(loaded) {
+            callbacks.progress(number, loaded);
+          }).done(function() {
+            running--;
+            if (callbacks.partDone) {
+              callbacks.partDone(number, blob.size);
+            }
+            next();
+          }).fail(function(message) {
+            failed = true;
+            deferred.reject(message);
+          });
+        })(queue.shift());
+      }
+    }
+
+    next();
+    return deferred.promise();
+  };
+
+  S3Multipart.prototype.partCount = function(file, partSize) {
+    return Math.max(1, Math.ceil(file.size / partSize));
+  };
+
+  // the saved upload of file if s3 still has it, with its parts refreshed
+  S3Multipart.prototype.resumable = function(file) {
+    var self = this;
+    var deferred = $.Deferred();
+    var upload = self.load(file);
+    if (!upload) {
+      return deferred.reject().promise();
+    }
+    self.call("parts", {key: upload.key, upload_id: upload.upload_id})
+      .done(function(listing) {
+        upload.parts = {};
+        $.each(listing.parts, function(i, part) {
+          upload.parts[part[0]] = part[1];
+        });
+        deferred.resolve(upload);
+      })
+      .fail(function(xhr) {
+        if (xhr.status == 403 || xhr.status == 404) {
+          self.forget(file);  // completed, aborted or from another portal
+        }
+        deferred.reject();
+      });
+    return deferred.promise();
+  };
+
+  // callbacks: progress(percent, bytesSent), success(key), error(message)
+  S3Multipart.prototype.upload = function(file, callbacks) {
+    var self = this;
+    var sent = {};
+
+    function progress(number, loaded) {
+      sent[number] = loaded;
+      var total = 0;
+      $.each(sent, function(n, bytes) { total += bytes; });
+      callbacks.progress(file.size ? 100 * total / file.size : 100, total);
+    }
+
+    function send(upload) {
+      var count = self.partCount(file, upload.partSize);
+      var numbers = [];
+      for (var n = 1; n <= count; n++) {
+        var size = Math.min(upload.partSize, file.size - (n - 1) * upload.partSize);
+        if (upload.parts[n] === size) {
+          progress(n, size);
+        } else {
+          numbers.push(n);
+        }
+      }
+      self.putParts(upload, file, numbers, {
+        progress: progress,
+        partDone: function(number, size) {
+          upload.parts[number] = size;
+          self.save(file, upload);
+        }
+      }).done(function() {
+        self.call("complete", {key: upload.key, upload_id: upload.upload_id})
+          .done(function() {
+            self.forget(file);
+            callbacks.success(upload.key);
+          })
+          .fail(function(xhr) {
+            if (xhr.status == 403) {
+              self.forget(file);  // rejected, the upload was discarded
+            }
+            callbacks.error(errorText(xhr));
+          });
+      }).fail(function(message) {
+        // keep the parts sent so far; adding the file again resumes
+        callbacks.error(message + ". Add the file again to resume the upload.");
+      });
+    }
+
+    self.resumable(file).done(send).fail(function() {
+      self.call("create", {filename: file.name}).done(function(upload) {
+        upload.partSize = S3Multipart.partSize(file.size);
+        upload.parts = {};
+        self.save(file, upload);
+        send(upload);
+      }).fail(function(xhr) {
+        callbacks.error(errorText(xhr));
+      });
+    });
+  };
+
+  function errorText(xhr) {
+    try {
+      return $.parseJSON(xhr.responseText).error;
+    } catch (e) {
+      return "Upload failed (" + xhr.status + ")";
+    }
+  }
+
+  return S3Multipart;
+})(jQuery);